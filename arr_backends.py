@@ -0,0 +1,180 @@
+import json
+import time
+import random
+import logging
+
+from typing import Callable
+from typing import Dict
+from typing import List
+
+logger = logging.getLogger("brokebot")
+
+LATENCY_SMOOTHING = 0.3 # Weight of the newest sample in each backend's moving average latency
+FAILURE_COOLDOWN = 60 # Seconds a failing backend is kept out of lookups before it's retried
+ROOT_FOLDER_CACHE_SECONDS = 300 # How long free space figures from /rootfolder are reused before asking again
+REQUEST_TIMEOUT = 30 # Seconds a call to a backend can take before it's given up on and counted as a failure
+
+
+class UnknownBackendError(Exception):
+    """ Raised when a backend is asked for by a name that isn't configured (anymore). """
+
+
+class Backend:
+    """A single Radarr or Sonarr instance, along with the settings used when adding media to it and a running record of its health.
+
+    Routing rules are a dict of media fields to accepted values, matched against the dict returned by the Radarr/Sonarr API.
+    A rule value may be a single value or a list; list-valued media fields (like genres) match if any of their values are accepted.
+    For example, `{"seriesType": "anime"}` or `{"genres": ["Anime"], "originalLanguage": "ja"}`.
+    """
+    __slots__ = ('name', 'kind', 'host', 'port', 'token', 'quality_profile', 'language_profile', 'rules', 'weight',
+                 'latency', 'failures', 'last_failure', 'root_folders', 'root_folders_checked')
+
+    def __init__(self, name: str, kind: str, host: str, port, token: str, quality_profile: int, language_profile: int = None,
+                 rules: dict = None, weight: float = 1.0):
+        self.name = name
+        self.kind = kind # 'radarr' or 'sonarr'
+        self.host = host
+        self.port = port
+        self.token = token
+        self.quality_profile = quality_profile
+        self.language_profile = language_profile
+        self.rules = rules or {}
+        self.weight = weight
+        self.latency = 1.0 # Moving average response time in seconds
+        self.failures = 0 # Consecutive failed calls
+        self.last_failure = 0.0
+        self.root_folders: List[dict] = []
+        self.root_folders_checked = 0.0
+
+    def url(self, call: str) -> str:
+        return f'http://{self.host}:{self.port}/api/v3/{call}'
+
+    def record(self, elapsed: float, ok: bool) -> None:
+        """Records the outcome of a call to this backend, for health-weighted load balancing."""
+        if ok:
+            self.latency = (1 - LATENCY_SMOOTHING) * self.latency + LATENCY_SMOOTHING * elapsed
+            self.failures = 0
+        else:
+            self.failures += 1
+            self.last_failure = time.monotonic()
+
+    @property
+    def health(self) -> float:
+        """Relative weight of this backend for lookups. Faster backends get more traffic; recently failing ones get almost none."""
+        if self.failures and time.monotonic() - self.last_failure < FAILURE_COOLDOWN:
+            return self.weight * 0.01 / self.failures
+        return self.weight / max(self.latency, 0.05)
+
+    def matches(self, media: dict) -> bool:
+        """Checks whether the given media satisfies all of this backend's routing rules. Backends without rules never match."""
+        if not self.rules: return False
+        for field, accepted in self.rules.items():
+            accepted = accepted if isinstance(accepted, list) else [accepted]
+            value = media.get(field)
+            values = value if isinstance(value, list) else [value]
+            if not any(v in accepted for v in values): return False
+        return True
+
+    def __repr__(self):
+        return f"Backend({self.kind}:{self.name} @ {self.host}:{self.port})"
+
+
+class BackendRegistry:
+    """Holds every configured Radarr/Sonarr instance, keyed by kind, and picks which one to use for a given call."""
+
+    def __init__(self):
+        self._backends: Dict[str, List[Backend]] = {}
+        self._defaults: Dict[str, Backend] = {} # Kind -> the instance configured through the plain env vars
+
+    def register(self, backend: Backend) -> None:
+        self._backends.setdefault(backend.kind, []).append(backend)
+        logger.info(f"Registered {backend}")
+
+    def load(self, kind: str, config: str, default: Backend) -> None:
+        """Registers the backends described in a JSON list config (usually from an env var), or the default backend if there's no config.
+
+        Each entry takes the keys: name, host, port, token, and optionally quality_profile, language_profile, rules and weight.
+        Missing settings fall back to the default backend's. The default backend's name keeps resolving (see `get`) even if no entry
+        uses it, so requests added before the instances were configured can still be found.
+        """
+        self._defaults[kind] = default
+        if not config:
+            self.register(default)
+            return
+
+        for entry in json.loads(config):
+            self.register(Backend(
+                name=entry['name'],
+                kind=kind,
+                host=entry.get('host', default.host),
+                port=entry.get('port', default.port),
+                token=entry.get('token', default.token),
+                quality_profile=entry.get('quality_profile', default.quality_profile),
+                language_profile=entry.get('language_profile', default.language_profile),
+                rules=entry.get('rules'),
+                weight=entry.get('weight', 1.0)
+            ))
+
+    def all(self, kind: str) -> List[Backend]:
+        return self._backends.get(kind, [])
+
+    def get(self, kind: str, name: str = None) -> Backend:
+        """Gets a backend by name, or the first registered one if no name is given (e.g. for requests made before there was more than one).
+
+        If no configured entry takes the default backend's name, that name resolves to the entry with the default's host and port, or
+        the first one. Raises UnknownBackendError if no backend has the name.
+        """
+        backends = self.all(kind)
+        if name is None: return backends[0]
+        backend = next((backend for backend in backends if backend.name == name), None)
+        default = self._defaults.get(kind)
+        if backend is None and default and name == default.name:
+            backend = next((backend for backend in backends if (backend.host, backend.port) == (default.host, default.port)), backends[0])
+        if backend is None: raise UnknownBackendError(f"No {kind} backend named '{name}' is configured.")
+        return backend
+
+    def for_lookup(self, kind: str) -> Backend:
+        """Picks a backend for a lookup that any instance can answer, weighted by health."""
+        backends = self.all(kind)
+        if len(backends) == 1: return backends[0]
+        return random.choices(backends, weights=[backend.health for backend in backends])[0]
+
+    def route(self, kind: str, media: dict) -> Backend:
+        """Picks the backend new media should be added to.
+
+        The first backend whose rules match wins. Otherwise the media goes to one of the backends without rules, weighted by health.
+        """
+        backends = self.all(kind)
+        routed = next((backend for backend in backends if backend.matches(media)), None)
+        if routed: return routed
+
+        general = [backend for backend in backends if not backend.rules] or backends
+        if len(general) == 1: return general[0]
+        return random.choices(general, weights=[backend.health for backend in general])[0]
+
+
+# Calls that are the same on Radarr and Sonarr. They take the integration's `get` function, so they go through its error handling
+
+def get_queue(backend: Backend, get: Callable, page_size: int) -> List[dict]:
+    """Retrieves every item in a backend's download queue. Usually a single call, unless the queue is longer than `page_size`."""
+    records, page = [], 1
+    while True:
+        queue = get(f'queue?page={page}&pageSize={page_size}', backend=backend)
+        records += queue['records']
+        if not queue['records'] or len(records) >= queue['totalRecords']: return records
+        page += 1
+
+
+def get_root_folder(backend: Backend, get: Callable, fallback_path: str) -> dict:
+    """Returns the root folder with the most free space on the given backend, or `fallback_path` with no free space if it has none.
+    Root folder stats are cached for ROOT_FOLDER_CACHE_SECONDS.
+    """
+    if time.monotonic() - backend.root_folders_checked > ROOT_FOLDER_CACHE_SECONDS:
+        backend.root_folders = get('rootfolder', backend=backend)
+        backend.root_folders_checked = time.monotonic()
+    if not backend.root_folders:
+        return {'path': fallback_path, 'freeSpace': 0}
+    return max(backend.root_folders, key=lambda folder: folder['freeSpace'])
+
+
+registry = BackendRegistry()
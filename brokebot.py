@@ -1,14 +1,19 @@
+import io
 import os
 import re
 import sys
+import asyncio
 import discord
 import logging
 import traceback
 # import extensions.plex_requests as plex_requests
 from enum import Enum
 from dotenv import load_dotenv
+from discord import app_commands
 from discord.ext import tasks, commands
 
+import diagnostics
+
 from typing import Coroutine
 
 # Bot token is loaded from an environment variable for security, so as to not be included in the source code. Create a file named '.env' in the same directory and add the token as a variable, or add the variable to your computer
@@ -21,6 +26,7 @@ BOT_TOKEN = os.getenv('BOT_TOKEN') # gets DISCORD_TOKEN environment variable fro
 BROKESERVER_GUILD_ID = os.getenv('BROKESERVER_GUILD_ID')
 DEBUG_LOGGING = True
 guild: discord.Guild
+watchdog: diagnostics.LoopWatchdog = None
 
 LOG_LEVEL = str(os.getenv('LOG_LEVEL'))
 DEPLOYMENT = str(os.getenv('DEPLOYMENT'))
@@ -89,6 +95,20 @@ async def _ping(interaction: discord.Interaction):
 async def _sync(ctx: commands.Context):
     await bot.tree.sync(ctx.guild)
 
+@bot.tree.command(name='profile')
+@app_commands.default_permissions(administrator=True)
+@app_commands.describe(seconds="How long to profile the bot for.")
+async def _profile(interaction: discord.Interaction, seconds: app_commands.Range[int, 1, 300] = 30):
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    try:
+        report = await diagnostics.profile(seconds, watchdog=watchdog)
+    except diagnostics.ProfilingInProgressError:
+        await interaction.followup.send("A profiling session is already running, try again once it's done.", ephemeral=True)
+        return
+    logger.info(f"Profiling report requested by {interaction.user}:\n{report}")
+    summary = '\n'.join(report.splitlines()[:2])
+    await interaction.followup.send(summary, file=discord.File(io.BytesIO(report.encode()), filename="profile.txt"), ephemeral=True)
+
 
 # EVENTS
 # ======================================================================================================================================
@@ -108,6 +128,9 @@ async def on_ready():
 
 @bot.event
 async def setup_hook():
+    global watchdog
+    watchdog = diagnostics.LoopWatchdog(asyncio.get_running_loop())
+    watchdog.start()
     # Dynamically load all extensions in the "extensions" directory :)
     for filename in os.listdir('./extensions'):
         if filename.endswith('.py') and filename != "__init__.py":
@@ -0,0 +1,114 @@
+import io
+import sys
+import time
+import pstats
+import asyncio
+import cProfile
+import logging
+import threading
+import traceback
+import tracemalloc
+
+logger = logging.getLogger("brokebot")
+
+LAG_THRESHOLD = 0.25 # Seconds the event loop can go without responding before the watchdog logs it
+LAG_CHECK_INTERVAL = 1.0 # Seconds between watchdog checks
+REPORT_TOP = 15 # Number of functions/allocations listed in each section of a profiling report
+
+
+class ProfilingInProgressError(Exception):
+    """ Raised when a profiling session is started while another one is still running. """
+
+
+class LoopWatchdog:
+    """Watches an event loop from a separate thread and logs whenever it stays blocked for longer than the threshold,
+    along with the stack of whatever was running on the loop at the time.
+
+    Checks from outside the loop, since a blocked loop can't time itself.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, threshold: float = LAG_THRESHOLD, interval: float = LAG_CHECK_INTERVAL):
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = 0 # Number of times the loop was blocked past the threshold
+        self.max_lag = 0.0 # Longest time the loop has been blocked, in seconds
+        self._loop_thread_id: int = None
+        self._stopped = threading.Event()
+        self._thread: threading.Thread = None
+
+    def start(self) -> None:
+        """Starts watching. Must be called from the loop's own thread."""
+        self._loop_thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"Event loop watchdog started (threshold {self.threshold}s).")
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            beat = threading.Event()
+            sent = time.monotonic()
+            try: self.loop.call_soon_threadsafe(beat.set)
+            except RuntimeError: return # Loop closed
+
+            if not beat.wait(self.threshold):
+                # The loop is blocked right now, so its current stack is the one doing the blocking.
+                # Logged straight away, since a stall that never ends would otherwise never be reported
+                frame = sys._current_frames().get(self._loop_thread_id)
+                stack = ''.join(traceback.format_stack(frame)) if frame else "(stack unavailable)"
+                self.stalls += 1
+                logger.warning(f"Event loop has been blocked for over {self.threshold}s. Blocking stack:\n{stack}")
+                while not beat.wait(self.interval):
+                    if self._stopped.is_set(): return
+                    self.max_lag = max(self.max_lag, time.monotonic() - sent) # Kept current so /profile reports ongoing stalls
+                lag = time.monotonic() - sent
+                self.max_lag = max(self.max_lag, lag)
+                logger.warning(f"Event loop recovered after being blocked for {lag:.2f}s.")
+
+            self._stopped.wait(self.interval)
+
+
+_profile_lock = asyncio.Lock()
+
+async def profile(duration: float, watchdog: LoopWatchdog = None, top: int = REPORT_TOP) -> str:
+    """Profiles the bot for `duration` seconds and returns a text report.
+
+    The report has the functions with the most cumulative time on the event loop thread (from cProfile), the largest new
+    memory allocations over the session (from tracemalloc) and, if a watchdog is given, its event loop lag stats.
+    Work done in other threads (e.g. asyncio.to_thread calls) only shows up as time spent awaiting it.
+    """
+    if _profile_lock.locked():
+        raise ProfilingInProgressError("A profiling session is already running.")
+
+    async with _profile_lock:
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing: tracemalloc.start(10)
+        before = tracemalloc.take_snapshot()
+        profiler = cProfile.Profile()
+        start = time.monotonic()
+        profiler.enable()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            profiler.disable()
+            elapsed = time.monotonic() - start
+            after = tracemalloc.take_snapshot()
+            if started_tracing: tracemalloc.stop()
+
+    report = io.StringIO()
+    report.write(f"Profiled for {elapsed:.1f}s\n")
+    if watchdog:
+        report.write(f"Event loop stalls over {watchdog.threshold}s since startup: {watchdog.stalls} (longest {watchdog.max_lag:.2f}s)\n")
+
+    report.write(f"\n== Top {top} functions by cumulative time ==\n")
+    stats = pstats.Stats(profiler, stream=report)
+    stats.strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+
+    report.write(f"\n== Top {top} allocations since the session started ==\n")
+    for stat in after.compare_to(before, 'lineno')[:top]:
+        report.write(f"{stat}\n")
+
+    return report.getvalue()
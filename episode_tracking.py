@@ -0,0 +1,113 @@
+import re
+from datetime import datetime, timezone
+
+from typing import Dict
+from typing import Iterable
+from typing import List
+
+# Season number -> (episode files, episodes). Episodes are the monitored ones that have aired or already have a file, like Sonarr's own
+# episodeCount statistic, so a season is complete once it has as many files as episodes
+SeasonCounts = Dict[int, tuple[int, int]]
+
+DEFAULT_SCOPE = "1" # Seasons tracked when a show request doesn't say, and for requests made before scopes existed
+ALL_SEASONS = "all"
+SCOPE_PATTERN = re.compile(r'^\s*(\d+)\s*(?:-\s*(\d+)\s*)?$') # One season or a range, e.g. "3" or "2-4"
+MAX_SEASON = 200
+
+
+def parse_scope(text: str) -> str:
+    """Normalizes a user-given season scope, e.g. "all", "2", "1-3" or "1, 4", into the form stored on requests ("all" or "1,2,3").
+    Raises ValueError if it isn't one.
+    """
+    if text is None or not text.strip(): return DEFAULT_SCOPE
+    if text.strip().lower() == ALL_SEASONS: return ALL_SEASONS
+    seasons = set()
+    for part in text.split(','):
+        match = SCOPE_PATTERN.match(part)
+        if not match: raise ValueError(f"'{part.strip()}' isn't a season number or range.")
+        first, last = int(match[1]), int(match[2] or match[1])
+        if not 1 <= first <= last <= MAX_SEASON: raise ValueError(f"'{part.strip()}' isn't a valid season range.")
+        seasons.update(range(first, last + 1))
+    return ','.join(str(season) for season in sorted(seasons))
+
+
+def fit_scope(scope: str, seasons: Iterable[int]) -> str:
+    """Fits a scope to the seasons a series actually has (from the `seasons` list of a Sonarr series object).
+
+    Seasons the series doesn't have are dropped, and the default scope means the lowest regular season when there's no season 1.
+    Returns None if none of the requested seasons exist. Scopes are left alone for series that don't list any seasons yet.
+    """
+    scope = scope or DEFAULT_SCOPE
+    available = {season for season in seasons if season > 0}
+    if scope == ALL_SEASONS or not available: return scope
+    if scope == DEFAULT_SCOPE and 1 not in available: return str(min(available))
+    fitted = [season for season in scope_seasons(scope, {}) if season in available]
+    return ','.join(str(season) for season in fitted) or None
+
+
+def scope_seasons(scope: str, counts: SeasonCounts) -> List[int]:
+    """Returns the season numbers a scope covers. "all" means every regular season with episodes so far, so it grows as new seasons air."""
+    scope = scope or DEFAULT_SCOPE
+    if scope == ALL_SEASONS: return sorted(season for season, (_, episodes) in counts.items() if season > 0 and episodes > 0)
+    return [int(season) for season in scope.split(',')]
+
+
+def describe_scope(scope: str) -> str:
+    """Describes a scope for messages to users, e.g. "the first season", "season 3" or "seasons 2, 3 and 4"."""
+    scope = scope or DEFAULT_SCOPE
+    if scope == ALL_SEASONS: return "every season"
+    if scope == "1": return "the first season"
+    seasons = scope.split(',')
+    if len(seasons) == 1: return f"season {seasons[0]}"
+    return f"seasons {', '.join(seasons[:-1])} and {seasons[-1]}"
+
+
+def complete_seasons(counts: SeasonCounts) -> set[int]:
+    return {season for season, (files, episodes) in counts.items() if episodes > 0 and files >= episodes}
+
+
+def is_scope_complete(scope: str, counts: SeasonCounts) -> bool:
+    seasons = scope_seasons(scope, counts)
+    return bool(seasons) and set(seasons) <= complete_seasons(counts)
+
+
+def newly_complete(scope: str, before: SeasonCounts, after: SeasonCounts) -> List[int]:
+    """Returns the seasons in scope that are complete in `after` but weren't in `before`."""
+    return sorted((complete_seasons(after) - complete_seasons(before or {})) & set(scope_seasons(scope, after)))
+
+
+def count_files(episode_files: List[dict]) -> Dict[int, int]:
+    """Counts the episode files of a series per season, from Sonarr's episodefile endpoint."""
+    files: Dict[int, int] = {}
+    for episode_file in episode_files:
+        files[episode_file['seasonNumber']] = files.get(episode_file['seasonNumber'], 0) + 1
+    return files
+
+
+def count_episodes(episodes: List[dict], files: Dict[int, int]) -> SeasonCounts:
+    """Builds season counts from Sonarr's episode endpoint and the file counts from `count_files`."""
+    now = datetime.now(timezone.utc)
+    totals: Dict[int, int] = {}
+    for episode in episodes:
+        aired = episode.get('airDateUtc') and datetime.fromisoformat(episode['airDateUtc'].replace('Z', '+00:00')) <= now
+        if episode.get('hasFile') or (episode.get('monitored') and aired):
+            totals[episode['seasonNumber']] = totals.get(episode['seasonNumber'], 0) + 1
+    return {season: (files.get(season, 0), totals.get(season, 0)) for season in totals.keys() | files.keys()}
+
+
+def from_statistics(series: dict) -> SeasonCounts:
+    """Builds season counts from the per-season statistics of a full Sonarr series object, for when one has already been fetched."""
+    counts = {}
+    for season in series.get('seasons', []):
+        statistics = season.get('statistics', {})
+        counts[season['seasonNumber']] = (statistics.get('episodeFileCount', 0), statistics.get('episodeCount', 0))
+    return counts
+
+
+def encode(counts: SeasonCounts) -> dict:
+    """Converts season counts to the JSON form stored in the database."""
+    return {str(season): list(season_counts) for season, season_counts in counts.items()}
+
+
+def decode(value: dict) -> SeasonCounts:
+    return {int(season): tuple(season_counts) for season, season_counts in value.items()}
@@ -1,7 +1,7 @@
 import asyncio
 import os
 import re
-import json
+import math
 import logging
 import discord
 import traceback
@@ -9,13 +9,21 @@ from enum import Enum
 from datetime import datetime
 from dotenv import load_dotenv
 from discord import app_commands
-from sqlite_utils import Database
 from sqlite_utils.db import NotFoundError
 from discord.ext import tasks, commands
 import requests
 
 import radarr_integration as radarr
 import sonarr_integration as sonarr
+import request_store as store
+import progress
+import episode_tracking
+from quota import QuotaEngine, QuotaLimits, QuotaResult
+from job_queue import JobQueue, Job, PermanentJobError
+from arr_backends import UnknownBackendError
+from progress import EditDebouncer
+from episode_tracking import SeasonCounts
+from request_store import Request, RequestState, RequestOutcome, MediaType, MediaInfo
 
 from typing import Coroutine
 from typing import Literal
@@ -30,43 +38,40 @@ BROKESERVER_GUILD_ID = os.getenv('BROKESERVER_GUILD_ID')
 PLEX_USER_ROLE_ID = os.getenv('PLEX_USER_ROLE_ID')
 DEPLOYMENT = os.getenv('DEPLOYMENT')
 
-db_path = '/var/lib/bot/' if DEPLOYMENT == 'PROD' else ''
-db = Database(f"{db_path}requests.db") 
-
 logger = logging.getLogger("brokebot")
 logger.debug(f"DEPLOYMENT: {os.getenv('DEPLOYMENT')}")
 logger.debug(f"TESTING var: {TESTING}")
 
-# Initialize the table
-REQUEST_SCHEMA = {
-    "id": int, #PK; is the thread ID from discord
-    "requestor_id": int,
-    "name": str, # Name of the request, from the title of the thread in discord
-    "timestamp": datetime, # Date and time the request was created, in datetime.datetime format 
-    "state": str, # State of the request: SEARCHING/PENDING_USER/DOWNLOADING/COMPLETE
-    "type": str, # MOVIE/SHOW, determines how request interactions should be processed
-    "media_info": dict, # JSON object of the movie or show info as it's pulled from radarr/sonarr
-    "search_results": dict # JSON object listing the objects returned from a successful radarr/sonarr search. Keys are just enumerations from 0
-}
-
-if not db["requests"].exists():
-    db.create_table("requests", REQUEST_SCHEMA, pk="id")
-    logger.info("Couldn't find 'requests' table in requests.db; created new.")
-else:
-    logger.info("Table 'requests' found in requests.db.")
-
 GUILD: discord.Guild
 PLEX_USER_ROLE: discord.Role
 
-MAX_REQUESTS = 3 # Maximum number of requests any one user can make
+MAX_REQUESTS = 3 # Maximum number of open requests any one user can have
+REQUEST_BURST = 3 # Maximum number of requests any one user can make back to back
+REQUESTS_PER_HOUR = 6 # Rate at which users can make requests once they've used up their burst
+ROLE_REQUEST_LIMITS = os.getenv('ROLE_REQUEST_LIMITS') # Optional JSON object of role IDs to more generous limits, see QuotaEngine.from_config
 MAX_TIME_PENDING = 1 if TESTING else 60 # Maximum amount of time (in minutes) that a request can stay pending before being removed
 DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+RECONCILE_TIMEOUT = 120 # Maximum amount of time (in seconds) the startup reconciliation can take before the bot moves on without it
+RECONCILE_CONCURRENCY = 4 # Maximum number of Radarr/Sonarr calls or DMs the startup reconciliation makes at once
+
+PAGE_SIZE = 20 # Search results shown per page of a select. Discord allows at most 25 options
+
+LIVE_SELECTS: set[int] = set() # IDs of requests still waiting on the user to pick an option. Selects for any other request are stale
+SEARCH_CACHE: Dict[int, 'SearchResults'] = {} # Compact search results of pending requests, keyed by request ID. Evicted when the request stops pending
+QUOTAS = QuotaEngine.from_config(QuotaLimits(MAX_REQUESTS, REQUEST_BURST, REQUESTS_PER_HOUR), ROLE_REQUEST_LIMITS)
+JOBS = JobQueue(store.db) # Durable queue for the search and add steps of requests
+JOB_WORKERS = 4 # Number of jobs worked on at once
+ADD_BATCH_WINDOW = 5 # Seconds confirmed selections are gathered for before they're added to Radarr/Sonarr together
+ADD_BATCH_SIZE = 25 # Maximum number of selections added in one batch
+PROGRESS_INTERVAL = 1 # Minutes between download queue checks for live progress
+STATUS_EDITS_PER_TICK = 10 # Maximum number of status messages sent or edited per queue check
+IN_QUEUE: set[int] = set() # IDs of requests whose media was in its backend's download queue at the last check
+STATUS = EditDebouncer() # Debounces edits to the status messages of downloading requests, keyed by request ID
 
 # TODO's:
 # ======================================================================================================================================
 # TODO: Switch all applicable interactions to ephemeral
 # TODO: Replace all prints with logging
-# TODO: Add a database cleanup step at startup, checking for deleted threads to remove from the db and new ones to add
 
 # EXCEPTIONS
 # ======================================================================================================================================
@@ -85,89 +90,111 @@ class SearchNotFoundError(Exception):
 class MaxRequestsError(Exception):
     """ An exception raised when a user makes a request when they have already reached their maximum number of requests (stored as a global var). """
 
+class RateLimitedError(Exception):
+    """ An exception raised when a user makes requests faster than their rate limit allows. """
+
+class InvalidSeasonsError(Exception):
+    """ An exception raised when the seasons given with a show request can't be parsed. """
+
 
 # DISCORD UI COMPONENTS
 # ======================================================================================================================================
-class MediaSelect(discord.ui.DynamicItem[discord.ui.Select], template=r'persistent_request_select:(?P<id>[0-9]+)'):
-    def __init__(self, request_id: int, search_results: list[dict] = None, placeholder: str = "Select an option...", id_key: str = 'tmdbId', label_key: str = 'title', year_key: str = 'year'):
-        self.request_id = request_id
-        self.search_results = search_results
-        self.id_key = id_key
-        self.label_key = label_key
-        self.year_key = year_key
-
-        request_options = []
-        if search_results:
-            for media in search_results:
-                label = media[label_key]
-                if year_key in media: 
-                    label += f" ({media[year_key]})"
-                media_id = media[id_key]
-                option = discord.SelectOption(label=label, value=media_id)
-                request_options.append(option)
-
-        super().__init__(discord.ui.Select(placeholder=placeholder, min_values=1, max_values=1, options=request_options, custom_id=f"persistent_request_select:{request_id}"))
+class SearchResults:
+    """Compact, in-memory copy of a request's search results, holding only what's needed to render pages of select options.
 
-    @classmethod
-    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Select, match: re.Match[str], /):
-        request_id = int(match['id'])
-        return cls(request_id)
+    The full results stay in the database and are only decoded again once the user picks one.
+    """
+    __slots__ = ('type', 'options')
 
-    async def callback(self, interaction: discord.Interaction):
-        # Lock the thread so you can't send any more interactions to avoid overlapping/repeated interactions
-        logger.debug(f"ReqSelect interacted from {interaction.user.id}.")
+    def __init__(self, type: MediaType, options: list[tuple[str, str]]):
+        self.type = type
+        self.options = options # (value, label) pairs, in search result order
 
-        await interaction.message.delete()
-        await interaction.response.defer()
+    @classmethod
+    def from_results(cls, type: MediaType, search_results: list[dict]) -> 'SearchResults':
+        id_key = 'tmdbId' if type == MediaType.MOVIE else 'tvdbId'
+        options = []
+        for media in search_results:
+            label = media['title']
+            if len(label) > 50: label = label[:50]+"..."
+            if 'year' in media: label += f" ({media['year']})"
+            options.append((str(media[id_key]), label))
+        return cls(type, options)
+
+    @property
+    def page_count(self) -> int:
+        return max(math.ceil(len(self.options) / PAGE_SIZE), 1)
+
+    def page(self, page: int) -> list[discord.SelectOption]:
+        return [discord.SelectOption(label=label, value=value) for value, label in self.options[page*PAGE_SIZE:(page+1)*PAGE_SIZE]]
+
+
+def get_search_results(request_id: int) -> SearchResults:
+    """Gets the cached search results for a pending request, rebuilding the cache entry from the database if needed (e.g. after a restart).
+    Returns None if the request is no longer pending.
+    """
+    if request_id not in LIVE_SELECTS: return None
+    if request_id not in SEARCH_CACHE:
+        try: request = store.get(request_id)
+        except NotFoundError: return None
+        SEARCH_CACHE[request_id] = SearchResults.from_results(request.type, request.search_results)
+    return SEARCH_CACHE[request_id]
 
-        selected_id = int(interaction.data['values'][0])
-        try: 
-            request = db['requests'].get(self.request_id)
-        except NotFoundError:
-            logger.info(f"User {interaction.user.id} responded to a request ({self.request_id}) that no longer exists. It may have timed out.")
-            await interaction.followup.send(f"Sorry! It seems like this selection is no longer available. It may have timed out before you had a chance to respond. Please re-create your request if you're still interested!", ephemeral=True)
-            return
 
-        self.search_results = json.loads(request["search_results"]).values()
+def forget_selects(request_id: int) -> None:
+    """Marks a request's selects as stale and evicts its cached search results."""
+    LIVE_SELECTS.discard(request_id)
+    SEARCH_CACHE.pop(request_id, None)
 
-        media = self.find_media_by_id(selected_id)
 
-        db["requests"].upsert({'id': self.request_id, 'media_info': media, 'name': media[self.label_key]}, pk='id')
+def finish_request(request: Request, outcome: RequestOutcome) -> None:
+    """Archives a request and releases everything held for it while it was open: its quota slot and any cached selects."""
+    finish_requests([(request, outcome)])
 
-        await self.handle_media(interaction, media)
 
-        set_state(self.request_id, 'DOWNLOADING')
+def finish_requests(finished_requests: list[tuple], finished: datetime = None) -> None:
+    """Archives a batch of (Request, RequestOutcome) pairs in one transaction, releasing their quota slots and cached selects."""
+    store.archive_many(finished_requests, finished)
+    for request, _ in finished_requests:
+        QUOTAS.leave(request.id)
+        forget_selects(request.id)
+        IN_QUEUE.discard(request.id)
+        STATUS.forget(request.id)
 
-    def find_media_by_id(self, selected_id: int):
-        return next(media for media in self.search_results if str(media[self.id_key]) == str(selected_id))
 
-    async def handle_media(self, interaction: discord.Interaction, media: dict):
-        raise NotImplementedError("This method should be implemented by subclasses.")
-    
+def build_select_view(request_id: int, page: int = 0) -> tuple[str, discord.ui.View]:
+    """Builds the message content and view for one page of a pending request's search results."""
+    results = get_search_results(request_id)
+    page = min(max(page, 0), results.page_count - 1)
+    select_view = discord.ui.View(timeout=None)
+    select = MovieSelect(request_id, results.page(page)) if results.type == MediaType.MOVIE else ShowSelect(request_id, results.page(page))
+    select_view.add_item(select)
+    if results.page_count > 1:
+        select_view.add_item(PageButton(request_id, page - 1, label="Previous", disabled=page == 0))
+        select_view.add_item(PageButton(request_id, page + 1, label="Next", disabled=page == results.page_count - 1))
+        return f"Here's what I found, please pick one (page {page + 1}/{results.page_count}):", select_view
+    return "Here's what I found, please pick one:", select_view
 
 
-class MovieSelect(discord.ui.DynamicItem[discord.ui.Select], template=r'persistent_request_select:(?P<id>[0-9]+)'):
-    def __init__(self, request_id: int, search_results:list[dict]=None):
-        self.request_id = request_id
-        self.search_results = search_results
+class RequestSelect(discord.ui.DynamicItem[discord.ui.Select], template=r'persistent_request_select:(?P<id>[0-9]+)'):
+    """Persistent select for picking one of a request's search results.
 
-        request_options = []
-        if search_results:
-            if len(search_results) > 20: search_results = search_results[:20]
-            for media in search_results:
-                label = media['title']
-                if len(label) > 50: label = label[:50]+"..."
-                if 'year' in media: label += f" ({media['year']})"
-                media_id = media['tmdbId']
-                option = discord.SelectOption(label=label, value=media_id)
-                request_options.append(option)
+    Movie and show selects share a custom_id template, so only this class is registered and it hands off to the subclass for the request's type.
+    """
+    placeholder = "Select an option..."
+    id_key = 'tmdbId' # Key of the search results' values
 
-        super().__init__(discord.ui.Select(placeholder=f"Select a Movie...", min_values=1, max_values=1, options=request_options, custom_id=f"persistent_request_select:{request_id}"))
+    def __init__(self, request_id: int, options: list[discord.SelectOption] = None):
+        self.request_id = request_id
+        self.search_results = None
+        super().__init__(discord.ui.Select(placeholder=self.placeholder, min_values=1, max_values=1, options=options or [], custom_id=f"persistent_request_select:{request_id}"))
 
     @classmethod
     async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Select, match: re.Match[str], /):
         request_id = int(match['id'])
-        return cls(request_id)
+        results = get_search_results(request_id)
+        if results and results.type == MediaType.SHOW: return ShowSelect(request_id)
+        return MovieSelect(request_id) # Stale selects are answered the same way by either
 
     async def callback(self, interaction: discord.Interaction):
         # Lock the thread so you can't send any more interactions to avoid overlapping/repeated interactions
@@ -175,113 +202,62 @@ class MovieSelect(discord.ui.DynamicItem[discord.ui.Select], template=r'persiste
 
         await interaction.message.delete()
         await interaction.response.defer()
-        
 
         selected_id = int(interaction.data['values'][0])
-        try: request = db['requests'].get(self.request_id)
+        try:
+            if self.request_id not in LIVE_SELECTS: raise NotFoundError # Stale select; skip the DB lookup
+            request = store.get(self.request_id)
         except NotFoundError:
             logger.info(f"User {interaction.user.id} responded to a request ({self.request_id}) that no longer exists. It may have timed out.")
             await interaction.followup.send(f"Sorry! It seems like this selection is no longer available. It may have timed out before you had a chance to respond. Please re-create your request if you're still interested!", ephemeral=True)
             return
 
-        self.search_results = json.loads(request["search_results"]).values()
+        self.search_results = request.search_results
 
-        movie = next(movie for movie in self.search_results if str(movie['tmdbId']) == str(selected_id))
-
-        db["requests"].upsert({'id': self.request_id, 'media_info': movie, 'name': movie['title']}, pk='id')
-
-        if movie['monitored']: # Check the movie to see if it is already added (monitored)
-            
-            if movie['isAvailable']: # Movie is monitored and available
-                await interaction.followup.send("Good news, this movie should already be available! Check Plex, and if you don't see it feel free to reach out to an administrator. Thanks!")
-                set_state(self.request_id, "COMPLETE")
-                db['requests'].delete(self.request_id)
-                return
-                # TODO: Get link from Plex to present
-            
-            else: # Movie is monitored but not available
-                await interaction.followup.send("Good news! This movie is already being monitored, though it's not available yet. I will keep your request open and notify you as soon as this movie is added!")
-
-        else: # Movie is not monitored and should be added to Radarr
-            added_movie = radarr.add(movie, download_now=(False if TESTING else True))
-            db['requests'].upsert({'id': self.request_id, 'media_info': added_movie}, pk='id') # Update record with new media_info from post response
+        media = next((media for media in self.search_results if str(media[self.id_key]) == str(selected_id)), None)
+        if media is None: # Keep the request pending and give the user a fresh select
+            logger.warning(f"Option {selected_id} picked for request {self.request_id} isn't in its search results.")
+            content, view = build_select_view(self.request_id)
+            await interaction.followup.send(f"Sorry, I couldn't find that option. {content}", view=view)
+            return
+        forget_selects(self.request_id) # No awaits since the LIVE_SELECTS check, so a second pick can't get past it
 
-            if movie['isAvailable']: # Movie is available for download now
-                await interaction.followup.send(f"Your request was successfully added and will be downloaded shortly! I'll let you know when it's finished.")
-            
-            else: # Movie is not available for download yet, and will be pending for a little while
-                await interaction.followup.send(f"I've added this movie, but it's not yet available for download. I'll let you know as soon as we get ahold of it!")
+        # Adding to Radarr/Sonarr and letting the user know happens in an add job, so it survives restarts
+        store.update(self.request_id, media=MediaInfo(media), name=media['title'], state=RequestState.ADDING)
+        JOBS.enqueue(f"add:{self.request_id}", 'add', {'request_id': self.request_id})
 
-        set_state(self.request_id, 'DOWNLOADING')
-        
 
+class PageButton(discord.ui.DynamicItem[discord.ui.Button], template=r'persistent_request_page:(?P<id>[0-9]+):(?P<page>[0-9]+)'):
+    """Persistent button that flips a request's select to another page of its search results, without searching again."""
 
-class ShowSelect(discord.ui.DynamicItem[discord.ui.Select], template=r'persistent_request_select:(?P<id>[0-9]+)'):
-    def __init__(self, request_id: int, search_results:list[dict]=None):
+    def __init__(self, request_id: int, page: int, label: str = None, disabled: bool = False):
         self.request_id = request_id
-        self.search_results = search_results
-
-        request_options = []
-        if search_results:
-            if len(search_results) > 20: search_results = search_results[:20]
-            for media in search_results:
-                label = media['title']
-                if len(label) > 50: label = label[:50]+"..."
-                if 'year' in media: label += f" ({media['year']})"
-                media_id = media['tvdbId']
-                option = discord.SelectOption(label=label, value=media_id)
-                request_options.append(option)
-
-        super().__init__(discord.ui.Select(placeholder=f"Select a Show...", min_values=1, max_values=1, options=request_options, custom_id=f"persistent_request_select:{request_id}"))
+        self.page = page
+        super().__init__(discord.ui.Button(label=label, style=discord.ButtonStyle.secondary, disabled=disabled, custom_id=f"persistent_request_page:{request_id}:{max(page, 0)}"))
 
     @classmethod
-    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Select, match: re.Match[str], /):
-        request_id = int(match['id'])
-        return cls(request_id)
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match: re.Match[str], /):
+        return cls(int(match['id']), int(match['page']))
 
     async def callback(self, interaction: discord.Interaction):
-        # Lock the thread so you can't send any more interactions to avoid overlapping/repeated interactions
-        logger.debug(f"ReqSelect interacted from {interaction.user.id}.")
-
-        await interaction.message.delete()
-        await interaction.response.defer()
-
-        selected_id = int(interaction.data['values'][0])
-        try: request = db['requests'].get(self.request_id)
-        except NotFoundError:
-            logger.info(f"User {interaction.user.id} responded to a request ({self.request_id}) that no longer exists. It may have timed out.")
-            await interaction.followup.send(f"Sorry! It seems like this selection is no longer available. It may have timed out before you had a chance to respond. Please re-create your request if you're still interested!", ephemeral=True)
+        if get_search_results(self.request_id) is None:
+            logger.info(f"User {interaction.user.id} paged a request ({self.request_id}) that no longer exists. It may have timed out.")
+            await interaction.message.delete()
+            await interaction.response.send_message(f"Sorry! It seems like this selection is no longer available. It may have timed out before you had a chance to respond. Please re-create your request if you're still interested!", ephemeral=True)
             return
-        
-        self.search_results = json.loads(request["search_results"]).values()
-        
-        show = next(show for show in self.search_results if str(show['tvdbId']) == str(selected_id))
 
-        db["requests"].upsert({'id': self.request_id, 'media_info': show, 'name': show['title']}, pk='id')
+        content, view = build_select_view(self.request_id, self.page)
+        await interaction.response.edit_message(content=content, view=view)
 
-        if 'id' in show: # Check if id field exists. If the field exists that means it's in the Sonarr DB
-        
-            if show['status'] == "upcoming": # show is monitored but not available
-                await interaction.followup.send("Good news! This show is already being monitored, though it's not available yet. I'll let you know when I'm able to get the first season of this show!")
-            
-            else: # show is monitored and available
-                await interaction.followup.send("Good news, this show is already being monitored and added in Plex! The latest episodes should already be downloaded, and new episodes will be downloaded as they become available.")
-                set_state(self.request_id, "COMPLETE")
-                db['requests'].delete(self.request_id)
-                return
-                # TODO: Get link from Plex to present
 
-        else: # Show is not monitored and should be added to Radarr
-            added_show = sonarr.add(show, download_now=(False if TESTING else True))
-            db['requests'].upsert({'id': self.request_id, 'media_info': added_show}, pk='id') # Update record with new media_info from post response
-            
-            if show['status'] == "upcoming": # show is not available for download yet, and will be pending for a little while
-                await interaction.followup.send(f"I've added this show, but it's not yet available for download. I'll let you know as soon as I get ahold of it!")
-            
-            else: # show is available for download now
-                await interaction.followup.send(f"Your request was successfully added and will be downloaded shortly! I'll let you know when I get the first season downloaded.")
+class MovieSelect(RequestSelect, template=r'persistent_request_select:(?P<id>[0-9]+)'):
+    placeholder = "Select a Movie..."
+    id_key = 'tmdbId'
 
-        set_state(self.request_id, 'DOWNLOADING')
+
+class ShowSelect(RequestSelect, template=r'persistent_request_select:(?P<id>[0-9]+)'):
+    placeholder = "Select a Show..."
+    id_key = 'tvdbId'
 
 # MISC FUNCTIONS
 # ======================================================================================================================================
@@ -296,21 +272,64 @@ async def can_dm_user(interaction: discord.Interaction) -> bool:
         return True
 
 
-def set_state(req_id: int, state: Literal['PENDING_USER', 'DOWNLOADING', 'COMPLETE']):
+async def if_user_is_plex_member(interaction: discord.Interaction) -> bool:
+    return interaction.user in PLEX_USER_ROLE.members
 
-    VALID_STATES = {'PENDING_USER', 'DOWNLOADING', 'COMPLETE'}
-    
-    if state not in VALID_STATES:
-        raise ValueError(f"set_state: state must be one of {VALID_STATES}")
 
-    db["requests"].upsert({'id': req_id, 'state': state}, pk='id')
-    # _print_db()
+def is_transient(error: Exception) -> bool:
+    """Whether an error is likely to go away if the same step is retried later (connection problems and server-side HTTP errors)."""
+    if isinstance(error, (ConnectionError, requests.ConnectionError, requests.Timeout)): return True
+    if isinstance(error, (radarr.HttpRequestException, sonarr.HttpRequestException)): return error.code >= 500
+    return False
+
+
+def integration_for(request: Request):
+    """Returns the integration module (radarr or sonarr) that handles a request's type."""
+    return radarr if request.type == MediaType.MOVIE else sonarr
+
+
+def request_error_message(error: Exception, user: discord.abc.User, type: str, query: str) -> str:
+    """Returns the message to DM a user for an error raised while processing their request, or None if it's an unexpected error."""
+    # Generic ConnectionError's (usually from radarr/sonarr)
+    if isinstance(error, (ConnectionError, requests.ConnectionError)):
+        return f"Sorry! It seems some of my resources are unavailable at the moment. This is usually temporary, please try again later but let an administrator know if the issue persists!"
+
+    # Custom errors
+    elif isinstance(error, MaxRequestsError):
+        return f"Sorry! You've reached the maximum ({QUOTAS.limits_for([role.id for role in getattr(user, 'roles', [])]).max_active}) number of requests. Please wait until your other requests complete before making any others!"
+    elif isinstance(error, RateLimitedError):
+        return f"Sorry! You're making requests a little too quickly. Please wait a bit before making another one!"
+    elif isinstance(error, InvalidSeasonsError):
+        return f"Sorry, I didn't understand which seasons you wanted ({error}). Try a season number like `2`, a range like `1-3`, or `all`."
+    elif isinstance(error, RequestIDConflictError):
+        return "Sorry, I ran into an error with your request. It seems there is already a request with the same ID as the one you created. Pleaes try again later."
+    elif isinstance(error, RequestQueryFailedError):
+        return "Sorry, I ran into a problem processing that request. A service may be down, please try again later."
+    elif isinstance(error, InsufficientStorageError):
+        return "Sorry! It seems we're out of space for the time being. Please submit this request another time."
+    elif isinstance(error, SearchNotFoundError):
+        logger.warning(f"No search results found for \"{query}\" ({type})")
+        return "Sorry, I didn't find anything by that name :(\nIf you think this was an error, please reach out to an administrator."
+    return None
+
+
+def unexpected_error_message(error: Exception) -> str:
+    """Returns the message to DM a user for an error nobody planned for, with enough detail for an administrator to find it in the logs."""
+    return f"Sorry! I ran into an issue processing this request. Please send this error along to the administrator to investigate:\n```{datetime.now().strftime(DATETIME_FORMAT)+':'+str(error)}```"
 
-async def if_user_is_plex_member(interaction: discord.Interaction) -> bool:
-    return interaction.user in PLEX_USER_ROLE.members
 
-# TODO: Add processing for optional year added in request
-async def process_request(id: int, requestor: discord.User, type: str, query: str) -> List[dict]:
+def backend_for(request: Request, media: dict):
+    """Returns the backend a request's media was routed to on an earlier attempt, or routes it now if there wasn't one.
+    Routing again on a retry could pick another backend and add the media to both.
+    """
+    integration = integration_for(request)
+    if request.backend:
+        try: return integration.get_backend(request.backend)
+        except UnknownBackendError: logger.warning(f"Request {request.id} was routed to backend '{request.backend}', which isn't configured anymore; routing it again.")
+    return integration.route(media)
+
+
+async def process_request(id: int, requestor: discord.User, type: str, query: str, season_scope: str = None) -> List[dict]:
     """Takes open threads and processes them for their request.
 
     Parameters
@@ -318,7 +337,8 @@ async def process_request(id: int, requestor: discord.User, type: str, query: st
     id: the ID of the request, used as a unique identifier in the database.
     requestor_id: the discord ID of the user who put in the request.
     type: string identifying the media type. (MOVIE|SHOW)
-    query: the string identifying the search query
+    query: the string identifying the search query. May be a title with an optional "(year)", a tmdb:/tvdb:/imdb: ID or a TMDB/TVDB/IMDb link
+    season_scope: for shows, the seasons the request is for, as returned by episode_tracking.parse_scope
 
     Returns
     -------
@@ -330,57 +350,47 @@ async def process_request(id: int, requestor: discord.User, type: str, query: st
     RequestQueryFailedError: Something went wrong with querying Sonarr/Radarr
     InsufficientStorageError: Insufficient storage for the request
     SearchNotFoundError: No results found
-    MaxRequestsError: User has already reached the maximum number of requests
+    HttpRequestException/ConnectionError: Radarr/Sonarr is unavailable; the search can be retried
     """
 
     # Check if request exists already in database
     try: 
-        user_request_count = db['requests'].count_where(f"requestor_id = {requestor.id}")
-        # if user_request_count >= MAX_REQUESTS: raise MaxRequestsError(f"User {requestor.name} ({requestor.id}) has already reached their maximum number of requests.")
-        db['requests'].get(id) # Expected to throw NotFoundError if the request ID doesn't already exist
+        store.get(id) # Expected to throw NotFoundError if the request ID doesn't already exist
         raise RequestIDConflictError(f"Request with ID '{id}' already in database.")
     
     except NotFoundError: 
         # Request doesn't exist; create a new one
         logger.info(f"{requestor.name} requested {type} '{query}'.")
         
-        if radarr.get_free_space() < 1.0:
+        free_space = await asyncio.to_thread(radarr.get_free_space)
+        if free_space < 1.0:
             # Insufficient free space on disk (buffer of 1 TB)
-            free_space = radarr.get_free_space()
             if free_space < 2.0: logger.warning(f"Plex storage low, only {free_space}TB remaining.")
             raise InsufficientStorageError(f"Insufficient storage for request, {free_space}TB remaining.")
 
         # Valid requests
-        request = {
-            'id': id,
-            'requestor_id': requestor.id,
-            'name': query,
-            'timestamp': datetime.now(),
-            'media_info': {},
-            'type': type
-        }
+        request = Request(id=id, requestor_id=requestor.id, name=query, type=MediaType(type), season_scope=season_scope if type == 'SHOW' else None)
 
         search_results: list[dict]
         try:
-            if type == 'MOVIE': search_results = radarr.search(query)
-            elif type == 'SHOW': search_results = sonarr.search(query)
+            if type == 'MOVIE': search_results = await asyncio.to_thread(radarr.search, query)
+            elif type == 'SHOW': search_results = await asyncio.to_thread(sonarr.search, query)
 
             if len(search_results) == 0: raise SearchNotFoundError(f"Failed to find any media by the given query '{query}'")
 
-            # Convert search_results array into a dict for storing in db
-            results = {}
-            for i, result in enumerate(search_results):
-                results[str(i)] = result # index needs to be in str format for jsonification
-
-            request['state'] = "PENDING_USER"
-            request['search_results'] = results
+            request.state = RequestState.PENDING_USER
+            request.search_results = search_results
 
-            db["requests"].insert(request)
+            store.insert(request)
+            QUOTAS.enter(requestor.id, id)
+            LIVE_SELECTS.add(id)
+            SEARCH_CACHE[id] = SearchResults.from_results(request.type, search_results)
             
             return search_results
 
-        except radarr.HttpRequestException as e:
-            raise SearchNotFoundError(f"Radarr server failed to process request for **{query}** with HTTP error code {e.code}.")
+        except (radarr.HttpRequestException, sonarr.HttpRequestException) as e:
+            if is_transient(e): raise
+            raise SearchNotFoundError(f"Server failed to process request for **{query}** with HTTP error code {e.code}.")
             
 
 
@@ -392,6 +402,9 @@ class PlexRequestCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self._dms: Dict[int, discord.DMChannel] = {} # Hashed dict keyed by user IDs containing opened DMs, to avoid many longer-running awaited open_dm() calls
+        self._reconciled = False # Whether the startup reconciliation has run. on_ready can fire again on reconnects
+        JOBS.register('search', self._search_job)
+        JOBS.register_batch('add', self._add_jobs, window=ADD_BATCH_WINDOW, max_size=ADD_BATCH_SIZE, on_failed=self._add_jobs_failed)
         logger.info(f"plex_requests cog started in {'test' if TESTING else 'prod'}.")
         # Global var inits
     
@@ -402,97 +415,486 @@ class PlexRequestCog(commands.Cog):
         return self._dms[user.id]
 
 
-    async def _check_request(self, request):
-        request_id = int(request['id'])
-        user_id = int(request['requestor_id'])
-        media_info = json.loads(request['media_info'])
-        logger.debug(f"Checking on request {str(request_id)} from {str(user_id)}:{str(request['state'])}")
+    async def _search_job(self, job: Job):
+        """Searches for a /request and DMs the requestor the results to pick from.
+
+        Idempotent on the request ID: if the search already ran before a restart, only the DM is sent again.
+        """
+        request_id, requestor_id, type, query = job.payload['request_id'], job.payload['requestor_id'], job.payload['type'], job.payload['query']
+        requestor = GUILD.get_member(requestor_id) or self.bot.get_user(requestor_id)
+        dm = await self.get_dm(requestor_id)
+
+        if not store.exists(request_id):
+            try:
+                await process_request(id=request_id, requestor=requestor, type=type, query=query, season_scope=job.payload.get('seasons'))
+            except Exception as e:
+                if is_transient(e) and not job.is_last_attempt: raise
+                if not store.exists(request_id): QUOTAS.leave(request_id) # No request was made, so the slot held for it is free again
+                message = request_error_message(e, requestor, type, query)
+                if message is None: # Unexpected, and retrying won't help; let the user know instead of failing silently
+                    logger.error(traceback.format_exc())
+                    await dm.send(unexpected_error_message(e))
+                    raise PermanentJobError(f"Search for request {request_id} failed: {e.__class__.__name__}: {e}") from e
+                await dm.send(message)
+                return
+        elif request_id not in LIVE_SELECTS: # Already picked or timed out
+            return
+
+        content, select_view = build_select_view(request_id)
+        await dm.send(content, view=select_view)
+
+
+    async def _add_jobs(self, jobs: List[Job]) -> Dict[str, Exception]:
+        """Adds the selected media of a batch of requests to Radarr/Sonarr and lets each requestor know how it went.
+
+        Media that's already in its routed backend's library is handled request by request. Everything else is added with one bulk
+        import call per backend, and the created records are mapped back to their requests by TMDB/TVDB ID.
+        Idempotent on the request ID: requests that aren't ADDING anymore are skipped, and media is looked up in the routed backend's
+        library before adding, so a retry after a crash doesn't add it twice.
+        Returns the errors of the jobs that should be retried.
+        """
+        pending: Dict[str, Request] = {} # Job key -> request
+        for job in jobs:
+            try: request = store.get(job.payload['request_id'])
+            except NotFoundError: continue
+            if request.state == RequestState.ADDING: pending[job.key] = request
+
+        errors: Dict[str, Exception] = {}
+        to_add: Dict[tuple, List[str]] = {} # (integration, backend name) -> keys of the jobs whose media needs adding there
+
+        async def check_library(key: str, request: Request):
+            try:
+                if not await self._check_library(request): to_add.setdefault((integration_for(request), request.backend), []).append(key)
+            except Exception as e:
+                errors[key] = e
+
+        await asyncio.gather(*(check_library(key, request) for key, request in pending.items()))
+
+        for (integration, backend_name), keys in to_add.items():
+            backend = integration.get_backend(backend_name)
+            batch = [pending[key].media.raw for key in keys]
+            added: List[dict] = []
+            try:
+                added = await asyncio.to_thread(integration.add_many, batch, download_now=(False if TESTING else True), backend=backend)
+            except Exception as e:
+                if len(keys) == 1 or is_transient(e):
+                    errors.update((key, e) for key in keys)
+                    continue
+                # One bad item fails the whole import, so add them one at a time instead, to keep it from failing the rest
+                logger.warning(f"Bulk import of {len(keys)} items to {integration.__name__} backend '{backend.name}' failed ({e}); adding them one at a time.")
+                for key, media in zip(keys, batch):
+                    try: added.append(await asyncio.to_thread(integration.add, media, download_now=(False if TESTING else True), backend=backend))
+                    except Exception as item_error: errors[key] = item_error
+
+            id_key = 'tmdbId' if integration is radarr else 'tvdbId'
+            added_by_id = {media.get(id_key): media for media in added}
+            for key in keys:
+                if key in errors: continue
+                request = pending[key]
+                media = added_by_id.get(request.media_id)
+                if media is None:
+                    errors[key] = RequestQueryFailedError(f"{request.media.title} was missing from the import response.")
+                    continue
+                try: await self._media_added(request, media)
+                except Exception as e: errors[key] = e
+
+        retry = {}
+        for job in jobs:
+            error = errors.get(job.key)
+            if error is None: continue
+            if is_transient(error) and not job.is_last_attempt:
+                retry[job.key] = error
+                continue
+            await self._add_failed(pending[job.key], error)
+        return retry
+
+
+    async def _add_jobs_failed(self, jobs: List[Job]):
+        """Fails the requests of add jobs that ran out of attempts without _add_jobs getting to them, e.g. because it raised."""
+        for job in jobs:
+            try: request = store.get(job.payload['request_id'])
+            except NotFoundError: continue
+            if request.state == RequestState.ADDING: await self._add_failed(request, f"{job} failed for good")
+
+
+    async def _add_failed(self, request: Request, error):
+        """Archives a request whose media couldn't be added as FAILED and lets the requestor know."""
+        logger.error(f"Couldn't add request {request.id} ({request.name}): {error}")
+        finish_request(request, RequestOutcome.FAILED)
+        try:
+            dm = await self.get_dm(request.requestor_id)
+            await dm.send(f"Sorry! I wasn't able to add **{request.name}**. Please try again later, and let an administrator know if the issue persists!")
+        except (discord.HTTPException, AttributeError) as e:
+            logger.warning(f"Couldn't notify {request.requestor_id} about request {request.id}: {e}")
+
+
+    async def _check_library(self, request: Request) -> bool:
+        """Routes a request's media to a backend and checks whether it's already in that backend's library, letting the user know if it is.
+        Returns False if the media still needs to be added.
+        """
+        if request.type == MediaType.MOVIE: return await self._check_movie_library(request)
+        return await self._check_show_library(request)
+
+
+    async def _media_added(self, request: Request, media: dict):
+        """Records the media created in Radarr/Sonarr for a request and lets the user know it's on its way."""
+        dm = await self.get_dm(request.requestor_id)
+        store.update(request.id, media=MediaInfo(media)) # Update record with new media_info from the add response
+
+        if request.type == MediaType.MOVIE:
+            if media['isAvailable']: # Movie is available for download now
+                await dm.send(f"Your request was successfully added and will be downloaded shortly! I'll let you know when it's finished.")
+            else: # Movie is not available for download yet, and will be pending for a little while
+                await dm.send(f"I've added this movie, but it's not yet available for download. I'll let you know as soon as we get ahold of it!")
+
+        else:
+            if media['status'] == "upcoming": # show is not available for download yet, and will be pending for a little while
+                await dm.send(f"I've added this show, but it's not yet available for download. I'll let you know as soon as I get ahold of it!")
+            else: # show is available for download now
+                await dm.send(f"Your request was successfully added and will be downloaded shortly! I'll let you know when I get {episode_tracking.describe_scope(request.season_scope)} downloaded.")
+
+        store.set_state(request.id, RequestState.DOWNLOADING)
+
+
+    async def _check_movie_library(self, request: Request) -> bool:
+        dm = await self.get_dm(request.requestor_id)
+        movie = request.media.raw
+        backend = backend_for(request, movie)
+        # Check the routed backend's own library, since search results may have come from a different backend
+        existing = await asyncio.to_thread(radarr.get_movie_by_tmdbid, movie['tmdbId'], backend)
+        movie = existing or (movie | {'monitored': False})
+        request.media = MediaInfo(movie)
+        request.backend = backend.name
+        store.update(request.id, media=request.media, backend=backend.name)
+
+        if not movie['monitored']: # Movie is not monitored and should be added to Radarr
+            return False
+
+        if movie['isAvailable']: # Movie is monitored and available
+            await dm.send("Good news, this movie should already be available! Check Plex, and if you don't see it feel free to reach out to an administrator. Thanks!")
+            finish_request(request, RequestOutcome.ALREADY_AVAILABLE)
+            return True
+            # TODO: Get link from Plex to present
+
+        # Movie is monitored but not available
+        await dm.send("Good news! This movie is already being monitored, though it's not available yet. I will keep your request open and notify you as soon as this movie is added!")
+        store.set_state(request.id, RequestState.DOWNLOADING)
+        return True
+
+
+    async def _check_show_library(self, request: Request) -> bool:
+        dm = await self.get_dm(request.requestor_id)
+        show = request.media.raw
+        backend = backend_for(request, show)
+        # Check the routed backend's own library, since search results may have come from a different backend
+        existing = await asyncio.to_thread(sonarr.get_show_by_tvdbid, show['tvdbId'], backend)
+        show = existing[0] if existing else {key: value for key, value in show.items() if key != 'id'}
+        request.media = MediaInfo(show)
+        request.backend = backend.name
+        store.update(request.id, media=request.media, backend=backend.name)
+
+        # Make sure the requested seasons exist, so the request can't wait forever on a season that never comes
+        scope = episode_tracking.fit_scope(request.season_scope, (season['seasonNumber'] for season in show.get('seasons', [])))
+        if scope is None:
+            await dm.send(f"Sorry! **{show['title']}** doesn't have {episode_tracking.describe_scope(request.season_scope)}. Please send another request for the seasons it does have!")
+            finish_request(request, RequestOutcome.FAILED)
+            return True
+        if scope != (request.season_scope or episode_tracking.DEFAULT_SCOPE):
+            if request.season_scope not in (None, episode_tracking.DEFAULT_SCOPE): # Only worth mentioning if the user picked the seasons
+                await dm.send(f"**{show['title']}** doesn't have all of the seasons you asked for, so I'll keep track of {episode_tracking.describe_scope(scope)} instead.")
+            request.season_scope = scope
+            store.update(request.id, season_scope=scope)
+
+        if 'id' not in show: # If the id field exists that means it's in the Sonarr DB; otherwise it should be added to Sonarr
+            return False
+
+        counts = episode_tracking.from_statistics(show)
+        if episode_tracking.is_scope_complete(request.season_scope, counts): # show is monitored and the requested seasons are downloaded
+            await dm.send("Good news, this show is already being monitored and added in Plex! The episodes you asked for should already be downloaded, and new episodes will be downloaded as they become available.")
+            finish_request(request, RequestOutcome.ALREADY_AVAILABLE)
+            return True
+            # TODO: Get link from Plex to present
+
+        # show is monitored but the requested seasons aren't all available yet
+        await dm.send(f"Good news! This show is already being monitored, though not everything you asked for is available yet. I'll let you know when I'm able to get {episode_tracking.describe_scope(request.season_scope)} of this show!")
+        request.episode_snapshot = counts
+        store.update(request.id, episode_snapshot=counts, state=RequestState.DOWNLOADING)
+        return True
+
+
+    async def _reconcile(self, notices: List[tuple[Request, str, bool]]):
+        """Brings the requests table back in line with Radarr/Sonarr at startup, before the first _check_requests_task tick.
+
+        1. Loads every open request in one query
+        2. Expires stale PENDING_USER requests and flushes stuck COMPLETE ones in one transaction
+        3. Marks the requests that are still pending as having live selects and makes sure ADDING ones have add jobs, before any
+           network call, so a slow or unreachable backend can't leave them stranded
+        4. Checks DOWNLOADING requests against each backend's full library, fetched once per backend with bounded concurrency,
+           and archives the ones that finished or were lost in one transaction. Requests on a backend that can't be reached are
+           left for _check_requests_task
+
+        The DMs for archived requests are appended to `notices` as (request, message, close status message) as soon as each group is
+        archived, to be sent with _send_notices once this is done or has timed out.
+        """
+        open_requests = store.open_requests()
+        logger.info(f"Reconciling {len(open_requests)} open requests.")
+        QUOTAS.rebuild(open_requests)
+        # Searches that haven't made their request yet still hold a slot
+        for job in JOBS.pending('search'): QUOTAS.enter(job.payload['requestor_id'], job.payload['request_id'])
+        semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+        now = datetime.now()
+
+        pending = [request for request in open_requests if request.state == RequestState.PENDING_USER]
+        downloading = [request for request in open_requests if request.state == RequestState.DOWNLOADING and request.media and request.media.id]
+        timed_out = [request for request in pending if request.age_minutes(now) > MAX_TIME_PENDING]
+        stuck = [request for request in open_requests if request.state == RequestState.COMPLETE]
+        finish_requests([(request, RequestOutcome.TIMED_OUT) for request in timed_out] + [(request, RequestOutcome.COMPLETED) for request in stuck], now)
+        notices += [(request, f"Sorry, your request for **{request.name}** has timed out. If you are still interested, please submit a new request.", False) for request in timed_out]
+
+        timed_out_ids = {request.id for request in timed_out}
+        LIVE_SELECTS.update(request.id for request in pending if request.id not in timed_out_ids)
+        # Make sure every request waiting to be added has an add job. No-op for those that already do
+        for request in open_requests:
+            if request.state == RequestState.ADDING: JOBS.enqueue(f"add:{request.id}", 'add', {'request_id': request.id})
+
+        # Fetch each backend's library once, instead of one call per request
+        async def fetch_library(integration, backend_name: str):
+            async with semaphore:
+                try:
+                    backend = integration.get_backend(backend_name)
+                    library = await asyncio.to_thread(integration.get_movies if integration is radarr else integration.get_shows, backend)
+                except Exception as e:
+                    logger.warning(f"Couldn't fetch the library of {integration.__name__} backend '{backend_name or 'default'}' ({e}); skipping its requests.")
+                    return (integration, backend_name), None
+                return (integration, backend_name), {media['id']: media for media in library}
+
+        library_keys = {(integration_for(request), request.backend) for request in downloading}
+        libraries = dict(await asyncio.gather(*(fetch_library(integration, backend_name) for integration, backend_name in library_keys)))
+
+        finished, lost = [], []
+        for request in downloading:
+            library = libraries[(integration_for(request), request.backend)]
+            if library is None: continue
+            media = library.get(request.media.id)
+            if media is None:
+                lost.append(request)
+            elif request.type == MediaType.MOVIE and media['hasFile']:
+                finished.append(request)
+            elif request.type == MediaType.SHOW and episode_tracking.is_scope_complete(request.season_scope, episode_tracking.from_statistics(media)):
+                finished.append(request)
+        finish_requests([(request, RequestOutcome.COMPLETED) for request in finished] + [(request, RequestOutcome.LOST) for request in lost])
+        notices += [(request, f"Your request for {request.media.title} has finished downloading and should be available on Plex shortly!"
+                     if request.type == MediaType.MOVIE else
+                     f"{episode_tracking.describe_scope(request.season_scope).capitalize()} of {request.media.title} has been downloaded and should be available on Plex soon! Further episodes will be downloaded as they come available.", True) for request in finished]
+        notices += [(request, f"Sorry! I seem to have lost track of your request for **{request.media.title}** while it was downloading... Please send another request if you think this was a mistake.", False) for request in lost]
+
+        logger.info(f"Reconciliation done: {len(timed_out)} timed out, {len(stuck)} stuck, {len(finished)} finished, {len(lost)} lost, {len(LIVE_SELECTS)} still pending.")
+
+
+    async def _send_notices(self, notices: List[tuple[Request, str, bool]]):
+        """DMs requestors about the requests _reconcile archived, with bounded concurrency, and closes their status messages if asked to."""
+        semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+
+        async def notify(request: Request, message: str, close_status: bool):
+            async with semaphore:
+                try:
+                    dm = await self.get_dm(request.requestor_id)
+                    await dm.send(message)
+                except (discord.HTTPException, AttributeError) as e:
+                    logger.warning(f"Couldn't notify {request.requestor_id} about request {request.id}: {e}")
+                if close_status: await self._close_status(request)
+
+        await asyncio.gather(*(notify(*notice) for notice in notices))
+
+
+    async def _check_request(self, request: Request):
+        request_id = request.id
+        user_id = request.requestor_id
+        media_info = request.media
+        logger.debug(f"Checking on request {str(request_id)} from {str(user_id)}:{request.state.value}")
 
         dm = await self.get_dm(user_id)
 
-        if request['state'] == "PENDING_USER": # Remove requests that have been pending longer than MAX_TIME_PENDING
-            time_created_str = request['timestamp']
-            logger.debug(f"Request {request_id} timestamp: {time_created_str}")
-            time_created = datetime.strptime(time_created_str, DATETIME_FORMAT)
-            time_now = datetime.now()
-            delta = time_now - time_created
-            d_minutes = delta.total_seconds() / 60
-            if d_minutes > MAX_TIME_PENDING: 
+        if request.state == RequestState.PENDING_USER: # Remove requests that have been pending longer than MAX_TIME_PENDING
+            logger.debug(f"Request {request_id} timestamp: {request.timestamp}")
+            if request.age_minutes() > MAX_TIME_PENDING: 
                 logger.info(f"Request {request_id} not responded to within {MAX_TIME_PENDING} minutes; removing.")
-                db['requests'].delete(request_id)
-                await dm.send(f"Sorry, your request for **{request['name']}** has timed out. If you are still interested, please submit a new request.")
+                finish_request(request, RequestOutcome.TIMED_OUT)
+                await dm.send(f"Sorry, your request for **{request.name}** has timed out. If you are still interested, please submit a new request.")
                 
 
-        if request['state'] == 'COMPLETE': # Completed requests should already be processed, but clean up any that get stuck
-            logger.warning(f"Completed request {request_id} was not cleaned up automatically; removing from DB now.")
-            db['requests'].delete(request_id)
+        if request.state == RequestState.COMPLETE: # Completed requests should already be processed, but clean up any that get stuck
+            logger.warning(f"Completed request {request_id} was not cleaned up automatically; archiving it now.")
+            finish_request(request, RequestOutcome.COMPLETED)
 
-        if request['state'] == "DOWNLOADING": # Only checking on requests that are currently downloading.
+        if request.state == RequestState.DOWNLOADING: # Only checking on requests that are currently downloading.
         # Check if this user has a DM open in our hash table already
-            media_id = media_info['id'] # ID internal to the Sonarr/Radarr database. ONLY present on items that have been added.
+            media_id = media_info.id # ID internal to the Sonarr/Radarr database. ONLY present on items that have been added.
+            try:
+                backend = integration_for(request).get_backend(request.backend)
+            except UnknownBackendError: # Checking some other backend would wrongly report the media as lost
+                logger.warning(f"Request {request_id} is on backend '{request.backend}', which isn't configured anymore; leaving it alone.")
+                return
 
             # Process Movies
-            if request['type'] == "MOVIE":
+            if request.type == MediaType.MOVIE:
+                if request_id in IN_QUEUE: # Still downloading as of the last queue check, no need to ask Radarr again
+                    logger.debug(f"Request for {media_info.title} with ID {request_id} is still in the download queue.")
+                    return
                 try:
-                    movie = radarr.get_movie_by_id(media_id)
+                    movie = await asyncio.to_thread(radarr.get_movie_by_id, media_id, backend=backend)
                 except radarr.HttpRequestException as e:
                     if e.code == 404: 
-                        await dm.send(f"Sorry! I seem to have lost track of your request for **{media_info['title']}** while it was downloading... Please send another request if you think this was a mistake.")
-                        db['requests'].delete(request_id)
+                        await dm.send(f"Sorry! I seem to have lost track of your request for **{media_info.title}** while it was downloading... Please send another request if you think this was a mistake.")
+                        finish_request(request, RequestOutcome.LOST)
                         return
-                except ConnectionError as e:
+                    raise
+                except (ConnectionError, requests.ConnectionError, requests.Timeout) as e:
                     logger.warning(f"Connection to resources timed out with error \"{str(e)}\"")
+                    return
 
                 if movie['hasFile']: # Is downloaded
                     await dm.send(f"Your request for {movie['title']} has finished downloading and should be available on Plex shortly!")
-                    db['requests'].delete(request_id)
-                    logger.info(f"Request for {movie['title']} with ID {request_id} finished downloading and was removed from the database.")
+                    await self._close_status(request)
+                    finish_request(request, RequestOutcome.COMPLETED)
+                    logger.info(f"Request for {movie['title']} with ID {request_id} finished downloading and was archived.")
                 else:
                     logger.debug(f"Request for {movie['title']} with ID {request_id} not finished downloading yet.")
 
             # Process Shows
-            elif request['type'] == "SHOW":
+            elif request.type == MediaType.SHOW:
                 try:
-                    show = sonarr.get_show_by_id(media_id)
+                    # Episode files are cheap to fetch; the episode list is only needed when the file counts have changed
+                    files = episode_tracking.count_files(await asyncio.to_thread(sonarr.get_episode_files, media_id, backend))
+                    snapshot = request.episode_snapshot
+                    if snapshot is not None and files == {season: season_files for season, (season_files, _) in snapshot.items() if season_files}:
+                        logger.debug(f"Request for {media_info.title} with ID {request_id} has no new episode files.")
+                        return
+                    episodes = await asyncio.to_thread(sonarr.get_episodes, media_id, backend)
+                    if not episodes: await asyncio.to_thread(sonarr.get_show_by_id, media_id, backend) # Raises a 404 if the show was removed
                 except sonarr.HttpRequestException as e:
                     if e.code == 404:
-                        await dm.send(f"Sorry! I seem to have lost track of your request for **{media_info['title']}** while it was downloading... Please send another request if you think this was a mistake.")
-                        db['requests'].delete(request_id)
+                        await dm.send(f"Sorry! I seem to have lost track of your request for **{media_info.title}** while it was downloading... Please send another request if you think this was a mistake.")
+                        finish_request(request, RequestOutcome.LOST)
                         return
-                except ConnectionError as e:
+                    raise
+                except (ConnectionError, requests.ConnectionError, requests.Timeout) as e:
                     logger.warning(f"Connection to resources timed out with error \"{str(e)}\"")
+                    return
+
+                await self._update_show(request, episode_tracking.count_episodes(episodes, files))
+
+    async def _update_show(self, request: Request, counts: SeasonCounts):
+        """Diffs a show request's season counts against its last snapshot, letting the user know about seasons in scope that just finished.
+        Archives the request once every season in its scope is complete.
+        """
+        dm = await self.get_dm(request.requestor_id)
+        title = request.media.title
+        if episode_tracking.is_scope_complete(request.season_scope, counts):
+            await dm.send(f"{episode_tracking.describe_scope(request.season_scope).capitalize()} of {title} has been downloaded and should be available on Plex soon! Further episodes will be downloaded as they come available.")
+            await self._close_status(request)
+            finish_request(request, RequestOutcome.COMPLETED)
+            logger.info(f"Request for {title} with ID {request.id} finished downloading and was archived.")
+            return
+
+        for season in episode_tracking.newly_complete(request.season_scope, request.episode_snapshot, counts):
+            await dm.send(f"Season {season} of {title} has been downloaded and should be available on Plex soon! I'll let you know when the rest of your request is done.")
+        request.episode_snapshot = counts
+        store.update(request.id, episode_snapshot=counts)
+        logger.debug(f"Request for {title} with ID {request.id}: {len(episode_tracking.complete_seasons(counts))} complete seasons, {counts}")
+
+    async def _post_status(self, request: Request, content: str):
+        """Edits a request's status message in place, or sends it if the request doesn't have one yet (or it was deleted)."""
+        try:
+            dm = await self.get_dm(request.requestor_id)
+            if request.status_message_id:
+                try:
+                    await dm.get_partial_message(request.status_message_id).edit(content=content)
+                    STATUS.sent(request.id, content)
+                    return
+                except discord.NotFound:
+                    pass
+            message = await dm.send(content)
+            STATUS.sent(request.id, content)
+            if store.exists(request.id): # May have finished while the message was being sent
+                request.status_message_id = message.id
+                store.update(request.id, status_message_id=message.id)
+        except (discord.HTTPException, AttributeError) as e:
+            logger.warning(f"Couldn't update the status message of request {request.id}: {e}")
+
+
+    async def _close_status(self, request: Request):
+        """Marks a finished request's status message as done, so it isn't left showing stale progress."""
+        if not request.status_message_id: return
+        try:
+            dm = await self.get_dm(request.requestor_id)
+            await dm.get_partial_message(request.status_message_id).edit(content=f"**{request.media.title}** has finished downloading.")
+        except (discord.HTTPException, AttributeError) as e:
+            logger.debug(f"Couldn't close the status message of request {request.id}: {e}")
+
+
+    async def _check_progress(self):
+        """Fetches each backend's download queue once and updates the status messages of the DOWNLOADING requests found in them.
+
+        Queue items are matched to requests by library ID, so this is one call per backend no matter how many requests are open.
+        Edits go through STATUS, which only lets a message be edited when its progress changed, at most once every MIN_EDIT_INTERVAL,
+        and no more than STATUS_EDITS_PER_TICK messages are touched per check.
+        """
+        downloading = [request for request in store.open_requests() if request.state == RequestState.DOWNLOADING and request.media and request.media.id]
+        semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+
+        async def fetch_queue(integration, backend_name: str):
+            async with semaphore:
+                try:
+                    records = await asyncio.to_thread(integration.get_queue, integration.get_backend(backend_name))
+                except (ConnectionError, requests.ConnectionError, requests.Timeout, radarr.HttpRequestException, sonarr.HttpRequestException, UnknownBackendError) as e:
+                    logger.warning(f"Couldn't fetch the download queue of {integration.__name__} backend '{backend_name or 'default'}': {e}")
+                    return (integration, backend_name), None
+                return (integration, backend_name), progress.summarize(records, 'movieId' if integration is radarr else 'seriesId')
+
+        queue_keys = {(integration_for(request), request.backend) for request in downloading}
+        queues = dict(await asyncio.gather(*(fetch_queue(integration, backend_name) for integration, backend_name in queue_keys)))
+
+        IN_QUEUE.clear()
+        in_queue: Dict[int, Request] = {}
+        for request in downloading:
+            queue = queues[(integration_for(request), request.backend)]
+            download = queue.get(request.media.id) if queue else None
+            if download is None: continue
+            IN_QUEUE.add(request.id)
+            in_queue[request.id] = request
+            STATUS.submit(request.id, download.describe(request.media.title))
+
+        await asyncio.gather(*(self._post_status(in_queue[request_id], content) for request_id, content in STATUS.due(in_queue, STATUS_EDITS_PER_TICK)))
 
-                season_one = next((season for season in show["seasons"] if season["seasonNumber"] == 1), None)
-                season_one_completion = season_one["statistics"]["percentOfEpisodes"]
-                if season_one_completion == 100.0: # Checks if 100% of the first season's episodes are downloaded.
-                    await dm.send(f"The first season of {show['title']} has been downloaded and should be available on Plex soon! Further episodes will be downloaded as they come available.")
-                    db['requests'].delete(request_id)
-                    logger.info(f"Request for {show['title']} with ID {request_id} finished downloading and was removed from the database.")
-                else:
-                    logger.debug(f"Request for {show['title']} with ID {request_id} {season_one_completion}% downloaded")
 
     # Commands
     @app_commands.command(name='request')
     @app_commands.describe(
         type="The type of media you'd like to request.",
-        query="The title of what you'd like to search for.")
+        query="The title of what you'd like to search for, optionally with a (year). Also accepts tmdb:/tvdb:/imdb: IDs and links.",
+        seasons="Shows only: which seasons you'd like, e.g. 2, 1-3 or all. Defaults to the first season.")
     @app_commands.check(if_user_is_plex_member)
     @app_commands.check(can_dm_user)
-    async def _request(self, interaction: discord.Interaction, type: Literal['Movie', 'Show'], *, query: str):
+    async def _request(self, interaction: discord.Interaction, type: Literal['Movie', 'Show'], *, query: str, seasons: str = None):
         logger.debug(f"Interaction data: {interaction.data}")
         id = interaction.id # Uses the id of the interaction as the PK in the database entry
         type = type.upper()
         requestor = interaction.user
         # Initialize a DMChannel, store DMChannel instance in self.dms if not present already
-        dm = await self.get_dm(requestor.id)
+        await self.get_dm(requestor.id)
         logger.info(f"Creating {type} request for {query}")
         await interaction.response.send_message(f"Thank you for the request! I'll DM you the search results when they're ready.", ephemeral=True)
 
-        results = await process_request(id=id, requestor=requestor, type=type, query=query)
-        select_view = discord.ui.View(timeout=None)
-        select = MovieSelect(request_id=id, search_results=results) if type == 'MOVIE' else ShowSelect(request_id=id, search_results=results)
-        select_view.add_item(select)
-        await dm.send("Here's what I found, please pick one:", view=select_view)
+        try: season_scope = episode_tracking.parse_scope(seasons) if type == 'SHOW' else None
+        except ValueError as e: raise InvalidSeasonsError(str(e))
+
+        quota = QUOTAS.acquire(requestor.id, [role.id for role in getattr(requestor, 'roles', [])], request_id=id) # Holds a slot until the search job either makes the request or gives up
+        if quota == QuotaResult.MAX_ACTIVE: raise MaxRequestsError(f"User {requestor.name} ({requestor.id}) has already reached their maximum number of requests.")
+        if quota == QuotaResult.RATE_LIMITED: raise RateLimitedError(f"User {requestor.name} ({requestor.id}) is making requests too quickly.")
+
+        # The search and DM happen in a search job, keyed by the interaction ID so the same request is never processed twice
+        JOBS.enqueue(f"search:{id}", 'search', {'request_id': id, 'requestor_id': requestor.id, 'type': type, 'query': query, 'seasons': season_scope})
         
     @_request.error
     async def _request_error(self, interaction: discord.Interaction, error: Exception):
@@ -513,28 +915,28 @@ class PlexRequestCog(commands.Cog):
         elif isinstance(error, discord.Forbidden) and error.code == 50007: # Cannot send messages to this user
             await interaction.response.send_message(f"Sorry, it appears that I cannot DM you! Unfortunately this is a requirement for the time being, but in the future we will switch to contextual interactions and a channel for updates on your requested media!", ephemeral=True)
 
-        # Generic ConnectionError's (usually from radarr/sonarr)
-        elif isinstance(error, ConnectionError):
-            await dm.send(f"Sorry! It seems some of my resources are unavailable at the moment. This is usually temporary, please try again later but let an administrator know if the issue persists!")
-
-        # Custom errors
-        elif isinstance(error, MaxRequestsError):
-            await dm.send(f"Sorry! You've reached the maximum ({MAX_REQUESTS}) number of requests. Please wait until your other requests complete before making any others!")
-        elif isinstance(error, RequestIDConflictError):
-            await dm.send("Sorry, I ran into an error with your request. It seems there is already a request with the same ID as the one you created. Pleaes try again later.")
-        elif isinstance(error, RequestQueryFailedError):
-            await dm.send("Sorry, I ran into a problem processing that request. A service may be down, please try again later.")
-        elif isinstance(error, InsufficientStorageError):
-            await dm.send("Sorry! It seems we're out of space for the time being. Please submit this request another time.")
-        elif isinstance(error, SearchNotFoundError):
-            logger.warning(f"No search results found for \"{args['query']}\" ({args['type']})")
-            await dm.send("Sorry, I didn't find anything by that name :(\nIf you think this was an error, please reach out to an administrator.")
+        # Errors processing the request itself
+        elif message := request_error_message(error, interaction.user, args['type'], args['query']):
+            await dm.send(message)
 
-        
         else:
             logger.debug(f"Typeof error raised: {type(error)}")
             logger.error(traceback.format_exc()) 
-            await dm.send(f"Sorry! I ran into an issue processing this request. Please send this error along to the administrator to investigate:\n```{datetime.now().strftime(DATETIME_FORMAT)+':'+str(error)}```")
+            await dm.send(unexpected_error_message(error))
+
+
+    @app_commands.command(name='request_stats')
+    @app_commands.default_permissions(administrator=True)
+    async def _request_stats(self, interaction: discord.Interaction):
+        """Summarizes finished requests from the request history archive."""
+        percentiles = store.completion_percentiles()
+        per_user = store.requests_per_user()
+
+        lines = ["**Time to complete**"]
+        lines += [f"p{p}: {minutes:.0f} min" for p, minutes in percentiles.items()] or ["No completed requests yet."]
+        lines.append("**Requests per user**")
+        lines += [f"<@{user_id}>: {count}" for user_id, count in list(per_user.items())[:10]] or ["No requests yet."]
+        await interaction.response.send_message('\n'.join(lines), ephemeral=True)
 
 
     # Event Listeners
@@ -543,7 +945,6 @@ class PlexRequestCog(commands.Cog):
     async def on_ready(self):
         logger.debug(f"plex_requests cog ready")
         # Add persistent views to bot
-        self.bot.add_dynamic_items(MovieSelect, ShowSelect)
         # initialize globals
         # TODO: make self-scoped vars instead of global
         global GUILD
@@ -551,8 +952,30 @@ class PlexRequestCog(commands.Cog):
         GUILD = self.bot.guilds[0]
         PLEX_USER_ROLE = GUILD.get_role(int(PLEX_USER_ROLE_ID))
         # TODO: Add tracking for threads that were in-process if the database gets reset. Or maybe just nuke the request forum if that happens..
+
+        notices = []
+        if not self._reconciled:
+            self._reconciled = True
+            try:
+                await asyncio.wait_for(self._reconcile(notices), timeout=RECONCILE_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"Startup reconciliation didn't finish within {RECONCILE_TIMEOUT}s; leaving the rest to _check_requests_task.")
+            except Exception:
+                logger.error(f"Startup reconciliation failed:\n{traceback.format_exc()}")
+            finally:
+                # Add persistent views to bot, now that we know which requests are still pending
+                self.bot.add_dynamic_items(RequestSelect, PageButton)
+                JOBS.start(JOB_WORKERS)
         
         if not self._check_requests_task.is_running(): self._check_requests_task.start()
+        if not self._progress_task.is_running(): self._progress_task.start()
+        # Sent outside the reconciliation timeout, so it can't cancel the DMs for requests that were already archived
+        await self._send_notices(notices)
+
+
+    async def cog_unload(self):
+        JOBS.stop()
+        self._progress_task.cancel()
 
 
     # Command error handling
@@ -571,8 +994,8 @@ class PlexRequestCog(commands.Cog):
         3.      Process state changes
         """
         
-        requests = [row for row in db["requests"].rows_where(order_by="requestor_id desc")] # Both MOVIE and SHOW request. Check by type
-        logger.info("Now checking open requests - "+(f"{len(requests)} : {[request['name'] for request in requests]}" if requests else '0'))
+        requests = store.open_requests() # Both MOVIE and SHOW request. Check by type
+        logger.info("Now checking open requests - "+(f"{len(requests)} : {[request.name for request in requests]}" if requests else '0'))
 
         # Process pending movies    
         for request in requests:
@@ -585,6 +1008,14 @@ class PlexRequestCog(commands.Cog):
             logger.warning(f"Failed to make requests to API backend; one or more services may be temporarily unavailable.")
         else: logger.error(f"An error occurred while handling _check_requests_task:\n{traceback.format_exc()}")
 
+    @tasks.loop(minutes=PROGRESS_INTERVAL)
+    async def _progress_task(self):
+        """Keeps the status messages of downloading requests up to date with live progress from the download queues."""
+        try:
+            await self._check_progress()
+        except Exception: # Caught here so one bad check doesn't stop the loop
+            logger.error(f"An error occurred while checking download progress:\n{traceback.format_exc()}")
+
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(PlexRequestCog(bot))
\ No newline at end of file
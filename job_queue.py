@@ -0,0 +1,236 @@
+import json
+import time
+import asyncio
+import logging
+import traceback
+from enum import Enum
+from sqlite_utils import Database
+
+from typing import Callable
+from typing import Coroutine
+from typing import Dict
+from typing import List
+
+logger = logging.getLogger("brokebot")
+
+JOB_SCHEMA = {
+    "key": str, # PK; idempotency key, e.g. "search:<interaction ID>". Enqueueing the same key twice is a no-op
+    "kind": str, # Which handler runs the job
+    "payload": dict, # JSON arguments for the handler
+    "state": str, # QUEUED/RUNNING/DONE/FAILED
+    "attempts": int, # Number of times the job has been started
+    "run_after": float, # Unix time before which the job shouldn't be run, for retry backoff
+    "last_error": str,
+    "created": float # Unix time the job was enqueued
+}
+
+MAX_ATTEMPTS = 5 # Attempts before a job is marked FAILED
+RETRY_BACKOFF = 5 # Seconds before the first retry; doubles with each attempt
+POLL_INTERVAL = 5 # Seconds idle workers wait before checking for due jobs again, if nothing wakes them sooner
+DONE_RETENTION = 24 * 60 * 60 # Seconds finished jobs are kept around to dedupe late retries of the same key
+
+
+class JobState(Enum):
+    QUEUED = 'QUEUED'
+    RUNNING = 'RUNNING'
+    DONE = 'DONE'
+    FAILED = 'FAILED'
+
+
+class PermanentJobError(Exception):
+    """ Raised by a handler when retrying the job won't help. The job is marked FAILED straight away. """
+
+
+class Job:
+    __slots__ = ('key', 'kind', 'payload', 'attempts')
+
+    def __init__(self, key: str, kind: str, payload: dict, attempts: int):
+        self.key = key
+        self.kind = kind
+        self.payload = payload
+        self.attempts = attempts
+
+    @property
+    def is_last_attempt(self) -> bool:
+        return self.attempts >= MAX_ATTEMPTS
+
+    def __repr__(self):
+        return f"Job({self.key}, attempt {self.attempts})"
+
+
+class JobQueue:
+    """A durable job queue stored in SQLite, worked by a pool of asyncio workers.
+
+    Jobs survive restarts: anything left RUNNING when the bot stopped is queued again on `start`.
+    Handlers are coroutines taking a Job. If one raises, the job is retried with exponential backoff up to MAX_ATTEMPTS,
+    unless it raised PermanentJobError. Handlers should be idempotent, since a job can run again after a crash.
+
+    Kinds registered with `register_batch` are handed to their handler several at a time: the worker that claims one waits a short
+    window for more of the same kind to come in, then runs them all together.
+    A kind can also have an `on_failed` hook, which is given its jobs once they've been marked FAILED, to clean up after them.
+    """
+
+    def __init__(self, db: Database, table: str = "jobs"):
+        self.db = db
+        self.table = table
+        self._handlers: Dict[str, Callable[[Job], Coroutine]] = {}
+        self._batches: Dict[str, tuple[float, int]] = {} # Kind -> (window, max size) of kinds that are run in batches
+        self._on_failed: Dict[str, Callable[[List[Job]], Coroutine]] = {} # Kind -> hook run on jobs that failed for good
+        self._gathering: set[str] = set() # Batched kinds a worker is currently waiting out the window for
+        self._workers: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+
+        if not db[table].exists():
+            db.create_table(table, JOB_SCHEMA, pk="key")
+            db[table].create_index(["state", "run_after"])
+            logger.info(f"Couldn't find '{table}' table in requests.db; created new.")
+
+    def register(self, kind: str, handler: Callable[[Job], Coroutine], on_failed: Callable[[List[Job]], Coroutine] = None) -> None:
+        self._handlers[kind] = handler
+        if on_failed: self._on_failed[kind] = on_failed
+
+    def register_batch(self, kind: str, handler: Callable[[List[Job]], Coroutine], window: float, max_size: int,
+                       on_failed: Callable[[List[Job]], Coroutine] = None) -> None:
+        """Registers a handler that takes a list of up to `max_size` jobs, gathered over `window` seconds after the first one is claimed.
+
+        The handler returns a dict of job keys to the errors of the jobs that failed (or None if they all succeeded). Those jobs are
+        retried on their own schedules, and the rest are marked DONE. If the handler raises, every job in the batch fails with that error.
+        """
+        self.register(kind, handler, on_failed)
+        self._batches[kind] = (window, max_size)
+
+    def enqueue(self, key: str, kind: str, payload: dict, delay: float = 0) -> bool:
+        """Adds a job to the queue. Returns False if a job with the same key already exists."""
+        now = time.time()
+        with self.db.conn:
+            cursor = self.db.execute(
+                f"INSERT OR IGNORE INTO {self.table} (key, kind, payload, state, attempts, run_after, created) VALUES (?, ?, ?, ?, 0, ?, ?)",
+                [key, kind, json.dumps(payload), JobState.QUEUED.value, now + delay, now]
+            )
+        if cursor.rowcount == 0: return False
+        self._wakeup.set()
+        return True
+
+    def claim(self, kind: str = None, limit: int = 1) -> List[Job]:
+        """Marks up to `limit` due jobs as RUNNING and returns them, oldest first."""
+        where = "state = ? AND run_after <= ?"
+        params = [JobState.QUEUED.value, time.time()]
+        if kind:
+            where += " AND kind = ?"
+            params.append(kind)
+        elif self._handlers:
+            kinds = [kind for kind in self._handlers if kind not in self._gathering] # Batched kinds are left for the worker gathering them
+            if not kinds: return []
+            where += f" AND kind IN ({', '.join('?' * len(kinds))})"
+            params += kinds
+        with self.db.conn:
+            rows = self.db.execute(f"SELECT key, kind, payload, attempts FROM {self.table} WHERE {where} ORDER BY run_after LIMIT ?", params + [limit]).fetchall()
+            if not rows: return []
+            keys = [row[0] for row in rows]
+            self.db.execute(f"UPDATE {self.table} SET state = ?, attempts = attempts + 1 WHERE key IN ({', '.join('?' * len(keys))})", [JobState.RUNNING.value] + keys)
+        return [Job(key, kind, json.loads(payload), attempts + 1) for key, kind, payload, attempts in rows]
+
+    def complete(self, job: Job) -> None:
+        self.db[self.table].update(job.key, {'state': JobState.DONE.value, 'last_error': None})
+
+    def fail(self, job: Job, error: Exception) -> bool:
+        """Records a failed attempt, scheduling a retry unless the job is out of attempts or the error is permanent.
+        Returns True if the job was marked FAILED.
+        """
+        message = f"{type(error).__name__}: {error}"
+        if isinstance(error, PermanentJobError) or job.is_last_attempt:
+            logger.error(f"{job} failed permanently: {message}")
+            self.db[self.table].update(job.key, {'state': JobState.FAILED.value, 'last_error': message})
+            return True
+        delay = RETRY_BACKOFF * 2 ** (job.attempts - 1)
+        logger.warning(f"{job} failed, retrying in {delay}s: {message}")
+        self.db[self.table].update(job.key, {'state': JobState.QUEUED.value, 'last_error': message, 'run_after': time.time() + delay})
+        return False
+
+    def pending(self, kind: str) -> List[Job]:
+        """Returns the jobs of a kind that haven't finished yet, queued or running."""
+        rows = self.db.execute(f"SELECT key, kind, payload, attempts FROM {self.table} WHERE kind = ? AND state IN (?, ?)", [kind, JobState.QUEUED.value, JobState.RUNNING.value]).fetchall()
+        return [Job(key, kind, json.loads(payload), attempts) for key, kind, payload, attempts in rows]
+
+    def requeue_running(self) -> int:
+        """Puts jobs that were RUNNING when the bot last stopped back in the queue. Returns how many there were."""
+        with self.db.conn:
+            cursor = self.db.execute(f"UPDATE {self.table} SET state = ? WHERE state = ?", [JobState.QUEUED.value, JobState.RUNNING.value])
+        return cursor.rowcount
+
+    def prune(self) -> None:
+        """Deletes finished jobs older than DONE_RETENTION."""
+        with self.db.conn:
+            self.db.execute(f"DELETE FROM {self.table} WHERE state IN (?, ?) AND created < ?", [JobState.DONE.value, JobState.FAILED.value, time.time() - DONE_RETENTION])
+
+    async def run(self, job: Job) -> None:
+        try:
+            await self._handlers[job.kind](job)
+        except Exception as e:
+            logger.debug(traceback.format_exc())
+            if self.fail(job, e): await self._failed([job])
+        else:
+            self.complete(job)
+
+    async def run_batch(self, jobs: List[Job]) -> None:
+        try:
+            errors = await self._handlers[jobs[0].kind](jobs) or {}
+        except Exception as e:
+            logger.debug(traceback.format_exc())
+            errors = {job.key: e for job in jobs}
+        failed = []
+        for job in jobs:
+            if job.key not in errors: self.complete(job)
+            elif self.fail(job, errors[job.key]): failed.append(job)
+        if failed: await self._failed(failed)
+
+    async def _failed(self, jobs: List[Job]) -> None:
+        """Runs the on_failed hook of the jobs' kind, if it has one."""
+        hook = self._on_failed.get(jobs[0].kind)
+        if hook is None: return
+        try:
+            await hook(jobs)
+        except Exception:
+            logger.error(f"on_failed hook for '{jobs[0].kind}' jobs raised:\n{traceback.format_exc()}")
+
+    async def _gather(self, first: Job) -> List[Job]:
+        """Waits out the batch window of the first job's kind, then claims more jobs of that kind to run alongside it."""
+        window, max_size = self._batches[first.kind]
+        self._gathering.add(first.kind)
+        try:
+            await asyncio.sleep(window)
+            return [first] + self.claim(first.kind, max_size - 1)
+        finally:
+            self._gathering.discard(first.kind)
+
+    async def _work(self, worker_id: int) -> None:
+        while True:
+            try:
+                jobs = self.claim()
+                if not jobs:
+                    self._wakeup.clear()
+                    try: await asyncio.wait_for(self._wakeup.wait(), timeout=POLL_INTERVAL)
+                    except asyncio.TimeoutError: pass
+                    continue
+                if jobs[0].kind in self._batches:
+                    batch = await self._gather(jobs[0])
+                    logger.debug(f"Worker {worker_id} running a batch of {len(batch)} '{jobs[0].kind}' jobs")
+                    await self.run_batch(batch)
+                    continue
+                logger.debug(f"Worker {worker_id} running {jobs[0]}")
+                await self.run(jobs[0])
+            except Exception: # e.g. the database being locked. Jobs it left RUNNING are requeued on the next start
+                logger.error(f"Job worker {worker_id} hit an error, carrying on in {POLL_INTERVAL}s:\n{traceback.format_exc()}")
+                await asyncio.sleep(POLL_INTERVAL)
+
+    def start(self, workers: int) -> None:
+        """Requeues interrupted jobs and starts the worker pool."""
+        if self._workers: return
+        requeued = self.requeue_running()
+        if requeued: logger.info(f"Requeued {requeued} jobs interrupted by the last shutdown.")
+        self.prune()
+        self._workers = [asyncio.create_task(self._work(i)) for i in range(workers)]
+
+    def stop(self) -> None:
+        for worker in self._workers: worker.cancel()
+        self._workers = []
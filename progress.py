@@ -0,0 +1,100 @@
+import time
+import logging
+from datetime import datetime
+
+from typing import Dict
+from typing import Hashable
+from typing import Iterable
+from typing import List
+
+logger = logging.getLogger("brokebot")
+
+MIN_EDIT_INTERVAL = 45 # Seconds a status message has to stay unchanged before it can be edited again. Kept under the progress check interval so timing jitter doesn't skip checks
+
+
+class DownloadProgress:
+    """Download progress of one movie or show, summed over all of its items in a Radarr/Sonarr queue (one per episode for shows)."""
+    __slots__ = ('size', 'sizeleft', 'eta', 'items', 'status')
+
+    def __init__(self, size: float = 0, sizeleft: float = 0, eta: datetime = None, items: int = 0, status: str = None):
+        self.size = size
+        self.sizeleft = sizeleft
+        self.eta = eta # When the last item is expected to finish, if the download client knows
+        self.items = items
+        self.status = status # Queue status of the items, e.g. "downloading", "queued", "paused". "downloading" if any of them are
+
+    @property
+    def percent(self) -> float:
+        if not self.size: return 0.0
+        return 100 * (self.size - self.sizeleft) / self.size
+
+    def add(self, record: dict) -> None:
+        self.size += record.get('size') or 0
+        self.sizeleft += record.get('sizeleft') or 0
+        self.items += 1
+        eta = record.get('estimatedCompletionTime')
+        if eta:
+            eta = datetime.fromisoformat(eta.replace('Z', '+00:00'))
+            self.eta = max(self.eta, eta) if self.eta else eta
+        status = (record.get('status') or 'unknown').lower()
+        if self.status != 'downloading': self.status = status
+
+    def describe(self, title: str) -> str:
+        """Renders a status message for the download. The ETA is a Discord timestamp, so it counts down without the message being edited."""
+        message = f"**{title}** is {self.status}: {self.percent:.0f}% done"
+        if self.items > 1: message += f" ({self.items} episodes)"
+        if self.eta and self.status == 'downloading': message += f", finishing <t:{int(self.eta.timestamp())}:R>"
+        return message + "."
+
+    def __repr__(self):
+        return f"DownloadProgress({self.percent:.1f}%, {self.items} items, {self.status})"
+
+
+def summarize(records: List[dict], id_key: str) -> Dict[int, DownloadProgress]:
+    """Groups queue records by the library ID under `id_key` (movieId for Radarr, seriesId for Sonarr) into one DownloadProgress each."""
+    progress: Dict[int, DownloadProgress] = {}
+    for record in records:
+        media_id = record.get(id_key)
+        if media_id is None: continue
+        progress.setdefault(media_id, DownloadProgress()).add(record)
+    return progress
+
+
+class EditDebouncer:
+    """Decides when status messages should actually be edited, to stay well inside Discord's rate limits.
+
+    Updates are submitted as often as they come in, but only the latest content for each message is kept, and a message is only due for
+    an edit if its content changed and it hasn't been edited in the last `min_interval` seconds. Everything submitted in between is
+    coalesced into that one edit.
+    """
+
+    def __init__(self, min_interval: float = MIN_EDIT_INTERVAL):
+        self.min_interval = min_interval
+        self._latest: Dict[Hashable, str] = {} # Key -> newest submitted content
+        self._sent: Dict[Hashable, tuple[str, float]] = {} # Key -> (content, monotonic time) of the last edit
+
+    def submit(self, key: Hashable, content: str) -> None:
+        self._latest[key] = content
+
+    def due(self, live: Iterable[Hashable], limit: int = None) -> List[tuple[Hashable, str]]:
+        """Returns (key, content) pairs that should be edited now, least recently edited first, up to `limit` of them.
+
+        Only keys in `live` are considered; updates still waiting for any other key are dropped, so messages that stopped being
+        updated can't take up the limit ahead of ones that are.
+        """
+        live = set(live)
+        for key in self._latest.keys() - live: del self._latest[key]
+        now = time.monotonic()
+        due = []
+        for key, content in self._latest.items():
+            sent_content, sent_at = self._sent.get(key, (None, float('-inf')))
+            if content != sent_content and now - sent_at >= self.min_interval: due.append((sent_at, key, content))
+        due.sort(key=lambda item: item[0])
+        return [(key, content) for _, key, content in due[:limit]]
+
+    def sent(self, key: Hashable, content: str) -> None:
+        self._sent[key] = (content, time.monotonic())
+
+    def forget(self, key: Hashable) -> None:
+        self._latest.pop(key, None)
+        self._sent.pop(key, None)
@@ -0,0 +1,75 @@
+import re
+
+from typing import List
+
+# Direct ID lookups, e.g. "tmdb:603", "tvdb: 81189", "imdb:tt0133093"
+ID_PATTERN = re.compile(r'^\s*(?P<source>tmdb|tvdb|imdb)(?:id)?\s*:\s*(?P<id>(?:tt)?\d+)\s*$', re.IGNORECASE)
+# Pasted links, e.g. "https://www.themoviedb.org/movie/603-the-matrix", "https://www.imdb.com/title/tt0133093/", "https://thetvdb.com/?tab=series&id=81189"
+TMDB_URL_PATTERN = re.compile(r'themoviedb\.org/(?P<kind>movie|tv)/(?P<id>\d+)', re.IGNORECASE)
+IMDB_URL_PATTERN = re.compile(r'imdb\.com/(?:[a-z-]+/)?title/(?P<id>tt\d+)', re.IGNORECASE)
+TVDB_URL_PATTERN = re.compile(r'thetvdb\.com/.*?[?&/](?:id=|series/)(?P<id>\d+)', re.IGNORECASE)
+# A year in parentheses or brackets at the end of a title, e.g. "The Thing (1982)"
+YEAR_PATTERN = re.compile(r'^(?P<term>.+?)\s*[\(\[](?P<year>(?:18|19|20)\d{2})[\)\]]\s*$')
+YEAR_TOLERANCE = 1 # Release years often differ by one between TMDB/TVDB and the user's memory
+
+
+class ParsedQuery:
+    """A /request query broken into the parts Radarr/Sonarr can look up directly.
+
+    At most one of tmdb_id, tvdb_id and imdb_id is set. If none are, `term` (and optionally `year`) should be used for a full-text lookup.
+    TMDB numbers movies and TV shows separately, so a TMDB ID from a link also records which of the two it is in `tmdb_kind`.
+    """
+    __slots__ = ('term', 'year', 'tmdb_id', 'tvdb_id', 'imdb_id', 'tmdb_kind')
+
+    def __init__(self, term: str, year: int = None, tmdb_id: int = None, tvdb_id: int = None, imdb_id: str = None, tmdb_kind: str = None):
+        self.term = term
+        self.year = year
+        self.tmdb_id = tmdb_id
+        self.tvdb_id = tvdb_id
+        self.imdb_id = imdb_id
+        self.tmdb_kind = tmdb_kind # 'movie' or 'tv' for TMDB links; None for a bare "tmdb:" ID, which is taken to match the request's type
+
+    @property
+    def is_id_lookup(self) -> bool:
+        return bool(self.tmdb_id or self.tvdb_id or self.imdb_id)
+
+    def __repr__(self):
+        return f"ParsedQuery(term={self.term!r}, year={self.year}, tmdb_id={self.tmdb_id}, tvdb_id={self.tvdb_id}, imdb_id={self.imdb_id}, tmdb_kind={self.tmdb_kind})"
+
+
+def parse(query: str) -> ParsedQuery:
+    """Parses a raw query into a ParsedQuery, recognizing "source:id" prefixes, pasted TMDB/TVDB/IMDb links and a trailing "(year)"."""
+    query = query.strip()
+
+    match = ID_PATTERN.match(query)
+    if match:
+        source, id = match['source'].lower(), match['id']
+        if source == 'imdb':
+            return ParsedQuery(query, imdb_id=id if id.lower().startswith('tt') else f"tt{id.zfill(7)}")
+        if id.lower().startswith('tt'): # IMDb-style ID given for another source; not a valid lookup
+            return ParsedQuery(query)
+        return ParsedQuery(query, **{f"{source}_id": int(id)})
+
+    match = TMDB_URL_PATTERN.search(query)
+    if match: return ParsedQuery(query, tmdb_id=int(match['id']), tmdb_kind=match['kind'].lower())
+    match = IMDB_URL_PATTERN.search(query)
+    if match: return ParsedQuery(query, imdb_id=match['id'])
+    match = TVDB_URL_PATTERN.search(query)
+    if match: return ParsedQuery(query, tvdb_id=int(match['id']))
+
+    match = YEAR_PATTERN.match(query)
+    if match: return ParsedQuery(match['term'], year=int(match['year']))
+
+    return ParsedQuery(query)
+
+
+def rank_by_year(results: List[dict], year: int) -> List[dict]:
+    """Narrows results to those released within YEAR_TOLERANCE of the given year, closest first.
+    If nothing is close, all results are kept but still ordered by how close their year is.
+    """
+    def distance(media: dict) -> int:
+        return abs(media['year'] - year) if media.get('year') else 9999
+
+    ranked = sorted(results, key=distance) # Stable, so upstream relevance order is kept between equally close results
+    close = [media for media in ranked if distance(media) <= YEAR_TOLERANCE]
+    return close or ranked
@@ -0,0 +1,117 @@
+import json
+import time
+import logging
+from enum import Enum
+
+from typing import Dict
+from typing import Iterable
+
+logger = logging.getLogger("brokebot")
+
+
+class QuotaResult(Enum):
+    OK = 'OK'
+    MAX_ACTIVE = 'MAX_ACTIVE' # User already has as many open requests as they're allowed
+    RATE_LIMITED = 'RATE_LIMITED' # User has made too many requests too quickly
+
+
+class QuotaLimits:
+    """Request limits for a user or role: a cap on open requests, and a token bucket of `burst` requests refilled at `per_hour`."""
+    __slots__ = ('max_active', 'burst', 'per_hour')
+
+    def __init__(self, max_active: int, burst: int, per_hour: float):
+        self.max_active = max_active
+        self.burst = burst
+        self.per_hour = per_hour
+
+    def __repr__(self):
+        return f"QuotaLimits(max_active={self.max_active}, burst={self.burst}, per_hour={self.per_hour})"
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens: float):
+        self.tokens = tokens
+        self.updated = time.monotonic()
+
+    def take(self, limits: QuotaLimits) -> bool:
+        """Refills the bucket for the time since it was last used, then takes a token if there is one."""
+        now = time.monotonic()
+        self.tokens = min(limits.burst, self.tokens + (now - self.updated) * limits.per_hour / 3600)
+        self.updated = now
+        if self.tokens < 1: return False
+        self.tokens -= 1
+        return True
+
+
+class QuotaEngine:
+    """Tracks open requests and request rates per user in memory, so enforcing limits doesn't need a database scan.
+
+    Open request counts are rebuilt from the database at startup with `rebuild`, then kept up to date with `enter` and `leave`
+    as requests are created and archived. Both are keyed by request ID, so calling them twice for the same request is harmless.
+    """
+
+    def __init__(self, default_limits: QuotaLimits, role_limits: Dict[int, QuotaLimits] = None):
+        self.default_limits = default_limits
+        self.role_limits = role_limits or {}
+        self._active: Dict[int, set] = {} # User ID -> IDs of their open requests
+        self._owners: Dict[int, int] = {} # Request ID -> user ID, so requests can leave by ID alone
+        self._buckets: Dict[int, TokenBucket] = {}
+
+    @classmethod
+    def from_config(cls, default_limits: QuotaLimits, config: str) -> 'QuotaEngine':
+        """Builds an engine from a JSON object of role IDs to limits (usually from an env var), e.g. `{"1234": {"max_active": 10, "per_hour": 20}}`.
+        Missing limits fall back to the defaults.
+        """
+        role_limits = {}
+        for role_id, limits in (json.loads(config) if config else {}).items():
+            role_limits[int(role_id)] = QuotaLimits(
+                max_active=limits.get('max_active', default_limits.max_active),
+                burst=limits.get('burst', default_limits.burst),
+                per_hour=limits.get('per_hour', default_limits.per_hour)
+            )
+        return cls(default_limits, role_limits)
+
+    def rebuild(self, open_requests: Iterable) -> None:
+        """Resets the open request counts from the given requests (anything with `id` and `requestor_id`)."""
+        self._active.clear()
+        self._owners.clear()
+        for request in open_requests:
+            self.enter(request.requestor_id, request.id)
+        logger.info(f"Quota counters rebuilt: {len(self._owners)} open requests across {len(self._active)} users.")
+
+    def limits_for(self, role_ids: Iterable[int] = ()) -> QuotaLimits:
+        """Returns the most generous limits out of the default and those of the given roles."""
+        limits = [self.role_limits[role_id] for role_id in role_ids if role_id in self.role_limits]
+        if not limits: return self.default_limits
+        return max(limits + [self.default_limits], key=lambda l: (l.max_active, l.per_hour, l.burst))
+
+    def active_count(self, user_id: int) -> int:
+        return len(self._active.get(user_id, ()))
+
+    def acquire(self, user_id: int, role_ids: Iterable[int] = (), request_id: int = None) -> QuotaResult:
+        """Checks whether a user may make a new request, taking a token from their rate limit bucket if so.
+
+        If they may and a `request_id` is given, the request counts as open from now on, so requests still being searched for count
+        towards the user's limit too. Call `leave` if it ends up never being made.
+        """
+        limits = self.limits_for(role_ids)
+        if self.active_count(user_id) >= limits.max_active:
+            return QuotaResult.MAX_ACTIVE
+        bucket = self._buckets.setdefault(user_id, TokenBucket(limits.burst))
+        if not bucket.take(limits):
+            return QuotaResult.RATE_LIMITED
+        if request_id is not None: self.enter(user_id, request_id)
+        return QuotaResult.OK
+
+    def enter(self, user_id: int, request_id: int) -> None:
+        self._active.setdefault(user_id, set()).add(request_id)
+        self._owners[request_id] = user_id
+
+    def leave(self, request_id: int) -> None:
+        user_id = self._owners.pop(request_id, None)
+        if user_id is None: return
+        active = self._active.get(user_id)
+        active.discard(request_id)
+        if not active: del self._active[user_id]
@@ -1,14 +1,25 @@
 import os
+import time
 import requests
+from urllib.parse import quote
 from dotenv import load_dotenv
 
+import query_parser
+from query_parser import ParsedQuery
+import arr_backends
+from arr_backends import Backend, registry, REQUEST_TIMEOUT
+
 load_dotenv()
 
 TORBOX_URL = os.getenv('TORBOX_URL')
 RADARR_TOKEN = os.getenv('RADARR_TOKEN')
 RADARR_PORT = os.getenv('RADARR_PORT')
+RADARR_INSTANCES = os.getenv('RADARR_INSTANCES') # Optional JSON list of Radarr instances, see BackendRegistry.load. Defaults to the single instance above
 DEFAULT_QUALITY_PROFILE = 4 # Think this is the ID of the profile, but it's the one seen in requests using the default 1080HD quality profile
-ROOT_FOLDER_PATH = '/nfs/plex-media/Movies'
+QUEUE_PAGE_SIZE = 1000 # Queue records fetched per call
+ROOT_FOLDER_PATH = '/nfs/plex-media/Movies' # Used if no root folders could be retrieved from the backend
+
+registry.load('radarr', RADARR_INSTANCES, default=Backend('default', 'radarr', TORBOX_URL, RADARR_PORT, RADARR_TOKEN, DEFAULT_QUALITY_PROFILE))
 
 # Custom Exceptions
 
@@ -24,62 +35,139 @@ class HttpRequestException(Exception):
 
 
 # Searches Radarr for a movie, returns a couple examples and prompts the user to select a choice. Filters by exact matches by default
-def search(query: str, exact=False):
-    query = query.lower()
-    results = get(f'movie/lookup?term={query}')
+# TMDB/IMDb IDs and links go to Radarr's single-item lookups; a trailing "(year)" narrows and ranks full-text results
+def search(query: str, exact=False, backend: Backend = None):
+    parsed = query_parser.parse(query)
+    if parsed.is_id_lookup:
+        return lookup_by_id(parsed, backend=backend)
+
+    term = parsed.term.lower()
+    results = get(f'movie/lookup?term={quote(term)}', backend=backend)
     matches = []
     if exact:
         for result in results:
-            if result['title'].lower() == query:
+            if result['title'].lower() == term:
                 matches.append(result)
     else: matches = results
-    return matches[:20] # Truncate results to 20 max to avoid errors sending options to discord
-
-def get_movie_by_id(id: int) -> dict: # ID is the internal database ID of the movie. Should throw error if not found
-    movie = get(f'movie/{id}')
+    if parsed.year: matches = query_parser.rank_by_year(matches, parsed.year)
+    return matches # Full results are kept; they're shown to the user a page at a time
+
+def lookup_by_id(parsed: ParsedQuery, backend: Backend = None) -> list[dict]:
+    """Looks up a single movie by its TMDB or IMDb ID. Returns an empty list if it isn't found, or if the ID is for a TMDB TV show."""
+    if parsed.tmdb_kind == 'tv': return [] # TMDB TV IDs would look up an unrelated movie
+    if parsed.tmdb_id: call = f'movie/lookup/tmdb?tmdbId={parsed.tmdb_id}'
+    elif parsed.imdb_id: call = f'movie/lookup/imdb?imdbId={quote(parsed.imdb_id)}'
+    else: return [] # Radarr can't look movies up by TVDB ID
+    try:
+        return [get(call, backend=backend)]
+    except HttpRequestException as e:
+        if e.code == 404: return []
+        raise
+
+def get_movie_by_id(id: int, backend: Backend = None) -> dict: # ID is the internal database ID of the movie. Should throw error if not found
+    movie = get(f'movie/{id}', backend=backend or get_backend())
     return movie
 
+def get_movie_by_tmdbid(tmdb_id: int, backend: Backend) -> dict:
+    """Retrieves a movie from a backend's library by its TMDB ID, or None if that backend doesn't have it."""
+    movies = get(f'movie?tmdbId={tmdb_id}', backend=backend)
+    return movies[0] if movies else None
+
+def get_movies(backend: Backend) -> list[dict]:
+    """Retrieves every movie in a backend's library in a single call."""
+    return get('movie', backend=backend)
+
+
+def get_queue(backend: Backend) -> list[dict]:
+    """Retrieves every item in a backend's download queue. Usually a single call, unless the queue is longer than QUEUE_PAGE_SIZE."""
+    return arr_backends.get_queue(backend, get, QUEUE_PAGE_SIZE)
+
+
+def get_backend(name: str = None) -> Backend:
+    """Gets a Radarr backend by name, or the default one if no name is given."""
+    return registry.get('radarr', name)
+
+def route(movie: dict) -> Backend:
+    """Picks the Radarr backend a movie should be added to."""
+    return registry.route('radarr', movie)
+
+
+def get_root_folder(backend: Backend) -> dict:
+    """Returns the root folder with the most free space on the given backend. Root folder stats are cached for a few minutes."""
+    return arr_backends.get_root_folder(backend, get, ROOT_FOLDER_PATH)
 
 
 def get_free_space(unit_exp: int = 4) -> float:
     """Returns the amount of free space on the server in TB.
 
+    With more than one backend, this is the most free space available in any one of their root folders. Backends that can't be
+    reached are skipped; the error is only raised if none of them can.
     If the unit_exp parameter is not passed, it defaults to 4, which corresponds to TB (1024^4)
     """
 
-    space_stats = get('rootfolder')
-    space_stats = space_stats[0]
-    free_space = space_stats['freeSpace']
-    return free_space / 1024**unit_exp
+    free_spaces, error = [], None
+    for backend in registry.all('radarr'):
+        try: free_spaces.append(get_root_folder(backend)['freeSpace'])
+        except (requests.RequestException, HttpRequestException) as e: error = e
+    if not free_spaces: raise error
+    return max(free_spaces) / 1024**unit_exp
 
 
 
-def add(movie: dict, download_now=True):
-    """Takes a standard dictionary returned from the Radarr API for the movie to be added as an argument, then tailors on some additional parameters and POST's it to the API."""
+def prepare(movie: dict, download_now=True, backend: Backend = None) -> dict:
+    """Returns a copy of a standard dictionary returned from the Radarr API, with the additional parameters needed to add it to the given backend (or the one it routes to)."""
 
-    movie_json = movie
-    movie_json['qualityProfileId'] = DEFAULT_QUALITY_PROFILE
-    movie_json['monitored'] = True
-    movie_json['id'] = 0 # Not sure why this needs to be zero. Observed in captured POST requests
-    movie_json['addOptions'] = {
-        'monitor': 'movieOnly',
-        'searchForMovie': download_now # Search for movie when added? False for troubleshooting ONLY
+    backend = backend or route(movie)
+    return movie | {
+        'qualityProfileId': backend.quality_profile,
+        'monitored': True,
+        'id': 0, # Not sure why this needs to be zero. Observed in captured POST requests
+        'addOptions': {
+            'monitor': 'movieOnly',
+            'searchForMovie': download_now # Search for movie when added? False for troubleshooting ONLY
+        },
+        'rootFolderPath': get_root_folder(backend)['path']
     }
-    movie_json['rootFolderPath'] = ROOT_FOLDER_PATH
 
-    return post('movie', movie_json)
+
+def add(movie: dict, download_now=True, backend: Backend = None):
+    """Takes a standard dictionary returned from the Radarr API for the movie to be added as an argument, tailors a copy with some additional parameters and POST's it to the API.
+
+    The movie is added to the given backend, or routed to one if none is given.
+    """
+
+    backend = backend or route(movie)
+    return post('movie', prepare(movie, download_now, backend), backend=backend)
+
+
+def add_many(movies: list[dict], download_now=True, backend: Backend = None) -> list[dict]:
+    """Adds several movies to one backend in a single call to Radarr's bulk import endpoint, and returns the created movies.
+
+    The backend defaults to the one the first movie routes to. Radarr rejects the whole batch if any one movie is invalid.
+    """
+
+    backend = backend or route(movies[0])
+    return post('movie/import', [prepare(movie, download_now, backend) for movie in movies], backend=backend)
 
 
 
 # Makes a get call to the V3 Radarr API using the extension of /api/v3/ without the preceding slash
+# Calls that aren't tied to one backend's library (lookups) are load balanced across backends when no backend is given
 # TODO: Generate errors based on error codes and FORCE error handling!
-def get(call, parameters={}):
+def get(call, parameters={}, backend: Backend = None):
+    backend = backend or registry.for_lookup('radarr')
     headers = {
         'Content-Type':'application/json',
-        'X-Api-Key':RADARR_TOKEN
+        'X-Api-Key':backend.token
     }
     headers = headers | parameters
-    res = requests.get(f'http://{TORBOX_URL}:{RADARR_PORT}/api/v3/{call}', headers=headers)
+    start = time.monotonic()
+    try:
+        res = requests.get(backend.url(call), headers=headers, timeout=REQUEST_TIMEOUT)
+    except (requests.ConnectionError, requests.Timeout):
+        backend.record(time.monotonic() - start, ok=False)
+        raise
+    backend.record(time.monotonic() - start, ok=res.status_code < 500)
     # HTTP error
     if res.status_code >= 300:
         raise HttpRequestException(res.status_code)
@@ -88,7 +176,7 @@ def get(call, parameters={}):
 
 
 
-def post(call, json) -> None:
+def post(call, json, backend: Backend = None) -> None:
     """Makes a post request with the given call and json body.
 
     Takes a call and json object as an argument, and makes a post request to the Radarr server passing that object as its json body.
@@ -96,11 +184,18 @@ def post(call, json) -> None:
 
     # Add necessary additional fields to json object
 
+    backend = backend or get_backend()
     headers = {
         'Content-Type':'application/json',
-        'X-Api-Key':RADARR_TOKEN
+        'X-Api-Key':backend.token
     }
-    res = requests.post(f"http://{TORBOX_URL}:{RADARR_PORT}/api/v3/{call}", headers=headers, json=json)
+    start = time.monotonic()
+    try:
+        res = requests.post(backend.url(call), headers=headers, json=json, timeout=REQUEST_TIMEOUT)
+    except (requests.ConnectionError, requests.Timeout):
+        backend.record(time.monotonic() - start, ok=False)
+        raise
+    backend.record(time.monotonic() - start, ok=res.status_code < 500)
 
     # HTTP code handling
     if res.status_code >= 300:
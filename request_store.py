@@ -0,0 +1,412 @@
+import os
+import json
+import math
+import logging
+from enum import Enum
+from datetime import datetime
+from dotenv import load_dotenv
+from sqlite_utils import Database
+from sqlite_utils.db import NotFoundError
+
+import episode_tracking
+from episode_tracking import SeasonCounts
+
+from typing import List
+from typing import Dict
+
+load_dotenv(override=True)
+DEPLOYMENT = os.getenv('DEPLOYMENT')
+
+db_path = '/var/lib/bot/' if DEPLOYMENT == 'PROD' else ''
+db = Database(f"{db_path}requests.db")
+db.enable_wal() # Lets readers (like export_jsonl) hold a snapshot without blocking the bot's writes
+
+logger = logging.getLogger("brokebot")
+
+# Initialize the table
+REQUEST_SCHEMA = {
+    "id": int, #PK; is the thread ID from discord
+    "requestor_id": int,
+    "name": str, # Name of the request, from the title of the thread in discord
+    "timestamp": datetime, # Date and time the request was created, in datetime.datetime format
+    "state": str, # State of the request: PENDING_USER/ADDING/DOWNLOADING/COMPLETE
+    "type": str, # MOVIE/SHOW, determines how request interactions should be processed
+    "media_info": dict, # JSON object of the movie or show info as it's pulled from radarr/sonarr
+    "search_results": dict, # JSON object listing the objects returned from a successful radarr/sonarr search. Keys are just enumerations from 0
+    "backend": str, # Name of the Radarr/Sonarr backend the media was added to. Null for requests added before there were backends. 'default' still resolves once RADARR_INSTANCES/SONARR_INSTANCES are set, see BackendRegistry.get
+    "status_message_id": int, # ID of the DM showing the request's download progress, which is edited in place. Null until it's first sent
+    "season_scope": str, # Seasons a show request is for: "all" or comma-separated season numbers. Null means the first season
+    "episode_snapshot": dict # Episode file and episode counts per season of a show request at its last check, see episode_tracking.SeasonCounts
+}
+
+# Columns needed to track a request. Leaves out search_results, which is only needed once the user picks an option
+TRACKING_COLUMNS = "id, requestor_id, name, timestamp, state, type, media_info, backend, status_message_id, season_scope, episode_snapshot"
+
+if not db["requests"].exists():
+    db.create_table("requests", REQUEST_SCHEMA, pk="id")
+    logger.info("Couldn't find 'requests' table in requests.db; created new.")
+else:
+    logger.info("Table 'requests' found in requests.db.")
+    # Add any columns introduced since the table was created
+    for column, column_type in REQUEST_SCHEMA.items():
+        if column not in db["requests"].columns_dict:
+            db["requests"].add_column(column, column_type)
+            logger.info(f"Added missing column '{column}' to 'requests' table.")
+
+# Append-only archive of finished requests. Kept separate so the live requests table only ever holds in-flight rows
+HISTORY_SCHEMA = {
+    "request_id": int, # PK; the ID the request had in the requests table
+    "requestor_id": int,
+    "type": str, # MOVIE/SHOW
+    "media_id": int, # TMDB ID for movies, TVDB ID for shows. Null if the request never got as far as a selection
+    "created": int, # Unix timestamp of when the request was created
+    "finished": int, # Unix timestamp of when the request left the requests table
+    "outcome": str # How the request ended, see RequestOutcome
+}
+
+if not db["request_history"].exists():
+    db.create_table("request_history", HISTORY_SCHEMA, pk="request_id")
+    db["request_history"].create_index(["requestor_id"])
+    db["request_history"].create_index(["outcome", "finished"])
+    # Expression index so time-to-complete percentiles can be read off the index in order
+    db.execute("CREATE INDEX IF NOT EXISTS idx_request_history_duration ON request_history(outcome, finished - created)")
+    logger.info("Couldn't find 'request_history' table in requests.db; created new.")
+
+
+# REQUEST MODEL
+# ======================================================================================================================================
+class RequestState(Enum):
+    PENDING_USER = 'PENDING_USER'
+    ADDING = 'ADDING' # User has picked an option and an add job is queued for it
+    DOWNLOADING = 'DOWNLOADING'
+    COMPLETE = 'COMPLETE'
+
+
+class MediaType(Enum):
+    MOVIE = 'MOVIE'
+    SHOW = 'SHOW'
+
+
+class RequestOutcome(Enum):
+    COMPLETED = 'COMPLETED' # Finished downloading
+    ALREADY_AVAILABLE = 'ALREADY_AVAILABLE' # Was already on Plex when the user picked it
+    TIMED_OUT = 'TIMED_OUT' # User never picked an option
+    LOST = 'LOST' # Removed from Radarr/Sonarr while downloading
+    FAILED = 'FAILED' # Couldn't be added to Radarr/Sonarr
+
+
+class MediaInfo:
+    """The media_info of a request, decoded once from the JSON stored in the database.
+
+    The commonly used fields are pulled out into attributes, and the original Radarr/Sonarr dict is kept in `raw` for when it needs to be posted back to the API.
+    """
+    __slots__ = ('id', 'title', 'year', 'tmdb_id', 'tvdb_id', 'imdb_id', 'raw')
+
+    def __init__(self, raw: dict):
+        self.raw = raw
+        self.id: int = raw.get('id') # ID internal to the Sonarr/Radarr database. ONLY present on items that have been added.
+        self.title: str = raw.get('title')
+        self.year: int = raw.get('year')
+        self.tmdb_id: int = raw.get('tmdbId')
+        self.tvdb_id: int = raw.get('tvdbId')
+        self.imdb_id: str = raw.get('imdbId')
+
+    @classmethod
+    def from_json(cls, value) -> 'MediaInfo | None':
+        """Builds a MediaInfo from a media_info column value, which may be a JSON string, a dict or empty."""
+        if not value: return None
+        data = json.loads(value) if isinstance(value, str) else value
+        return cls(data) if data else None
+
+    def __repr__(self):
+        return f"MediaInfo(id={self.id}, title={self.title!r}, year={self.year})"
+
+
+class Request:
+    """A single row of the requests table.
+
+    Rows are decoded once when read from the database: the timestamp is parsed, the state and type become enums and media_info becomes a MediaInfo.
+    search_results is only decoded when it's first accessed, since most reads never look at it.
+    """
+    __slots__ = ('id', 'requestor_id', 'name', 'timestamp', 'state', 'type', 'media', 'backend', 'status_message_id', 'season_scope', 'episode_snapshot', '_search_results')
+
+    def __init__(self, id: int, requestor_id: int, name: str, type: MediaType, state: RequestState = RequestState.PENDING_USER,
+                 timestamp: datetime = None, media: MediaInfo = None, backend: str = None, status_message_id: int = None, season_scope: str = None,
+                 episode_snapshot: SeasonCounts = None, search_results: list[dict] = None):
+        self.id = id
+        self.requestor_id = requestor_id
+        self.name = name
+        self.type = type
+        self.state = state
+        self.timestamp = timestamp or datetime.now()
+        self.media = media
+        self.backend = backend
+        self.status_message_id = status_message_id
+        self.season_scope = season_scope
+        self.episode_snapshot = episode_snapshot
+        self._search_results = search_results
+
+    @classmethod
+    def from_row(cls, row: dict) -> 'Request':
+        timestamp = row.get('timestamp')
+        if isinstance(timestamp, str): timestamp = datetime.fromisoformat(timestamp)
+        state = row.get('state')
+        snapshot = row.get('episode_snapshot')
+        if isinstance(snapshot, str): snapshot = json.loads(snapshot)
+        request = cls(
+            id=int(row['id']),
+            requestor_id=int(row['requestor_id']),
+            name=row.get('name'),
+            type=MediaType(row['type']),
+            state=RequestState(state) if state else None,
+            timestamp=timestamp,
+            media=MediaInfo.from_json(row.get('media_info')),
+            backend=row.get('backend'),
+            status_message_id=row.get('status_message_id'),
+            season_scope=row.get('season_scope'),
+            episode_snapshot=episode_tracking.decode(snapshot) if snapshot else None
+        )
+        request.search_results = row.get('search_results') # Left encoded until it's needed
+        return request
+
+    def to_row(self) -> dict:
+        return {
+            'id': self.id,
+            'requestor_id': self.requestor_id,
+            'name': self.name,
+            'timestamp': self.timestamp,
+            'state': self.state.value if self.state else None,
+            'type': self.type.value,
+            'media_info': self.media.raw if self.media else {},
+            'backend': self.backend,
+            'status_message_id': self.status_message_id,
+            'season_scope': self.season_scope,
+            'episode_snapshot': episode_tracking.encode(self.episode_snapshot) if self.episode_snapshot is not None else None,
+            # Stored as a dict keyed by enumeration, index needs to be in str format for jsonification
+            'search_results': {str(i): result for i, result in enumerate(self.search_results)}
+        }
+
+    @property
+    def search_results(self) -> list[dict]:
+        if self._search_results is None:
+            self._search_results = []
+        elif isinstance(self._search_results, str):
+            self._search_results = list(json.loads(self._search_results).values())
+        elif isinstance(self._search_results, dict):
+            self._search_results = list(self._search_results.values())
+        return self._search_results
+
+    @search_results.setter
+    def search_results(self, results: list[dict]):
+        self._search_results = results
+
+    @property
+    def media_id(self) -> int:
+        """The external ID of the selected media: TMDB ID for movies, TVDB ID for shows."""
+        if not self.media: return None
+        return self.media.tmdb_id if self.type == MediaType.MOVIE else self.media.tvdb_id
+
+    def age_minutes(self, now: datetime = None) -> float:
+        """Returns how long ago the request was created, in minutes."""
+        return ((now or datetime.now()) - self.timestamp).total_seconds() / 60
+
+    def __repr__(self):
+        return f"Request(id={self.id}, requestor_id={self.requestor_id}, name={self.name!r}, type={self.type.name}, state={self.state.name if self.state else None})"
+
+
+# DATABASE ACCESS
+# ======================================================================================================================================
+def get(request_id: int) -> Request:
+    """Gets a single request by its ID. Raises NotFoundError if it doesn't exist."""
+    return Request.from_row(db['requests'].get(request_id))
+
+
+def exists(request_id: int) -> bool:
+    try:
+        db['requests'].get(request_id)
+        return True
+    except NotFoundError:
+        return False
+
+
+def insert(request: Request) -> None:
+    db['requests'].insert(request.to_row())
+
+
+def update(request_id: int, **fields) -> None:
+    """Updates the given columns of a request. Enums and MediaInfo values are converted to their stored form."""
+    row = {'id': request_id}
+    for key, value in fields.items():
+        if isinstance(value, Enum): value = value.value
+        if key == 'media':
+            key, value = 'media_info', (value.raw if value else {})
+        if key == 'episode_snapshot' and value is not None:
+            value = episode_tracking.encode(value)
+        row[key] = value
+    db['requests'].upsert(row, pk='id')
+
+
+def set_state(request_id: int, state: RequestState) -> None:
+    if not isinstance(state, RequestState):
+        raise ValueError(f"set_state: state must be one of {[s.value for s in RequestState]}")
+    update(request_id, state=state)
+
+
+def delete(request_id: int) -> None:
+    db['requests'].delete(request_id)
+
+
+def open_requests() -> List[Request]:
+    """Returns every request in the database, without search results, for periodic checks."""
+    return [Request.from_row(row) for row in db['requests'].rows_where(order_by="requestor_id desc", select=TRACKING_COLUMNS)]
+
+
+def archive(request: Request, outcome: RequestOutcome, finished: datetime = None) -> None:
+    """Moves a finished request out of the requests table and into request_history, in a single transaction."""
+    archive_many([(request, outcome)], finished)
+
+
+def archive_many(finished_requests: List[tuple], finished: datetime = None) -> None:
+    """Archives a batch of (Request, RequestOutcome) pairs in a single transaction."""
+    if not finished_requests: return
+    finished = int((finished or datetime.now()).timestamp())
+    with db.conn:
+        _insert_rows('request_history', [{
+            'request_id': request.id,
+            'requestor_id': request.requestor_id,
+            'type': request.type.value,
+            'media_id': request.media_id,
+            'created': int(request.timestamp.timestamp()),
+            'finished': finished,
+            'outcome': outcome.value
+        } for request, outcome in finished_requests], replace=True)
+        db.conn.executemany("DELETE FROM requests WHERE id = ?", [(request.id,) for request, _ in finished_requests])
+
+
+def _insert_rows(table: str, rows: List[dict], replace: bool = False) -> int:
+    """Inserts rows with a plain executemany, so they're written in the caller's transaction (sqlite_utils' insert_all commits by itself).
+    dict/list values are stored as JSON, like sqlite_utils does. Returns the number of rows written.
+    """
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    values = [[json.dumps(value) if isinstance(value, (dict, list)) else value for value in (row.get(column) for column in columns)] for row in rows]
+    return db.conn.executemany(
+        f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO [{table}] ({', '.join(f'[{column}]' for column in columns)}) VALUES ({', '.join('?' * len(columns))})",
+        values
+    ).rowcount
+
+
+# HISTORY QUERIES
+# ======================================================================================================================================
+def completion_percentiles(percentiles: tuple = (50, 90, 99), type: MediaType = None) -> Dict[int, float]:
+    """Returns the time (in minutes) it took for completed requests to finish downloading, at each of the given percentiles.
+
+    Uses nearest-rank percentiles, all found in one pass over the durations in order, stopping at the highest one.
+    Without a type filter the order is read off the duration index; with one, the matching rows have to be sorted first.
+    """
+    where = "outcome = ?"
+    params = [RequestOutcome.COMPLETED.value]
+    if type:
+        where += " AND type = ?"
+        params.append(type.value)
+
+    total = db['request_history'].count_where(where, params)
+    results = {}
+    if total == 0: return results
+    ranks = {percentile: max(math.ceil(percentile / 100 * total) - 1, 0) for percentile in percentiles}
+    cursor = db.execute(f"SELECT finished - created FROM request_history WHERE {where} ORDER BY finished - created LIMIT ?", params + [max(ranks.values()) + 1])
+    for rank, (duration,) in enumerate(cursor):
+        for percentile, percentile_rank in ranks.items():
+            if percentile_rank == rank: results[percentile] = duration / 60
+    return {percentile: results[percentile] for percentile in percentiles}
+
+
+def requests_per_user(since: datetime = None) -> Dict[int, int]:
+    """Returns the number of finished requests for each requestor, optionally only counting those finished since the given time."""
+    sql = "SELECT requestor_id, COUNT(*) FROM request_history"
+    params = []
+    if since:
+        sql += " WHERE finished >= ?"
+        params.append(int(since.timestamp()))
+    sql += " GROUP BY requestor_id ORDER BY COUNT(*) DESC"
+    return {requestor_id: count for requestor_id, count in db.execute(sql, params).fetchall()}
+
+
+# EXPORT/IMPORT
+# ======================================================================================================================================
+SCHEMAS = {"requests": (REQUEST_SCHEMA, "id"), "request_history": (HISTORY_SCHEMA, "request_id")}
+EXPORT_BATCH_SIZE = 500 # Rows read/written per chunk when exporting or importing
+
+
+def export_jsonl(path: str, table: str = "requests", batch_size: int = EXPORT_BATCH_SIZE) -> int:
+    """Streams a table out to a JSONL file, one row per line, and returns the number of rows written.
+
+    Reads through a separate connection inside one read transaction, so the export is a consistent snapshot. The database is in
+    WAL mode, so that transaction doesn't block the bot's writes and the export can run while the bot is up. Only one batch of rows is held in memory at a time. JSON columns are written as nested objects.
+    """
+    schema, pk = SCHEMAS[table]
+    json_columns = {column for column, column_type in schema.items() if column_type is dict}
+    count = 0
+    reader = Database(f"{db_path}requests.db")
+    try:
+        reader.execute("BEGIN")
+        cursor = reader.execute(f"SELECT * FROM [{table}] ORDER BY [{pk}]")
+        columns = [description[0] for description in cursor.description]
+        with open(path, 'w', encoding='utf-8') as file:
+            while batch := cursor.fetchmany(batch_size):
+                lines = []
+                for values in batch:
+                    row = dict(zip(columns, values))
+                    for column in json_columns:
+                        if isinstance(row.get(column), str): row[column] = json.loads(row[column])
+                    lines.append(json.dumps(row) + '\n')
+                file.writelines(lines)
+                count += len(batch)
+        reader.execute("COMMIT")
+    finally:
+        reader.close()
+    logger.info(f"Exported {count} rows from '{table}' to {path}.")
+    return count
+
+
+def import_jsonl(path: str, table: str = "requests", batch_size: int = EXPORT_BATCH_SIZE, replace: bool = False) -> int:
+    """Streams rows from a JSONL file into a table, one transaction per batch, and returns the number of rows written.
+
+    Rows whose primary key already exists are skipped (and not counted), or overwritten if `replace` is set. Keys that aren't
+    columns of the table are dropped, so exports from older or newer schemas can be restored.
+    """
+    schema, _ = SCHEMAS[table]
+    lines = written = 0
+
+    def flush(batch: List[dict]) -> int:
+        with db.conn:
+            return _insert_rows(table, batch, replace=replace)
+
+    with open(path, encoding='utf-8') as file:
+        batch = []
+        for line in file:
+            if not line.strip(): continue
+            lines += 1
+            batch.append({column: value for column, value in json.loads(line).items() if column in schema})
+            if len(batch) >= batch_size:
+                written += flush(batch)
+                batch = []
+        if batch:
+            written += flush(batch)
+    logger.info(f"Imported {written} of {lines} rows into '{table}' from {path}.")
+    return written
+
+
+if __name__ == '__main__':
+    # Backups and restores from the command line, e.g. `python request_store.py export backup.jsonl`
+    import argparse
+    parser = argparse.ArgumentParser(description="Export or import the requests database as JSONL.")
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('path', help="JSONL file to write to or read from.")
+    parser.add_argument('--table', choices=list(SCHEMAS), default="requests")
+    parser.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE)
+    parser.add_argument('--replace', action='store_true', help="On import, overwrite rows that already exist instead of skipping them.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.action == 'export': export_jsonl(args.path, args.table, args.batch_size)
+    else: import_jsonl(args.path, args.table, args.batch_size, args.replace)
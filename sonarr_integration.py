@@ -1,15 +1,26 @@
 import os
+import time
 import requests
+from urllib.parse import quote
 from dotenv import load_dotenv
 
+import query_parser
+from query_parser import ParsedQuery
+import arr_backends
+from arr_backends import Backend, registry, REQUEST_TIMEOUT
+
 load_dotenv()
 
 TORBOX_URL = os.getenv('TORBOX_URL')
 SONARR_TOKEN = os.getenv('SONARR_TOKEN')
 SONARR_PORT = os.getenv('SONARR_PORT')
+SONARR_INSTANCES = os.getenv('SONARR_INSTANCES') # Optional JSON list of Sonarr instances, see BackendRegistry.load. Defaults to the single instance above
 DEFAULT_QUALITY_PROFILE = 4 # ID of the custom 1080HD quality profile. Separate quality profile for Anime
 DEFAULT_LANGUAGE_PROFILE = 1 # ID of the English language profile. Separate language profile for Anime
-ROOT_FOLDER_PATH = '/nfs/plex-media/Shows'
+QUEUE_PAGE_SIZE = 1000 # Queue records fetched per call
+ROOT_FOLDER_PATH = '/nfs/plex-media/Shows' # Used if no root folders could be retrieved from the backend
+
+registry.load('sonarr', SONARR_INSTANCES, default=Backend('default', 'sonarr', TORBOX_URL, SONARR_PORT, SONARR_TOKEN, DEFAULT_QUALITY_PROFILE, DEFAULT_LANGUAGE_PROFILE))
 
 # Custom Exceptions
 
@@ -25,75 +36,157 @@ class HttpRequestException(Exception):
 
 
 # Searches Sonarr for a series, returns a couple examples and prompts the user to select a choice. Filters by exact matches by default
-def search(query: str, exact=False):
-    query = query.lower()
-    results = get(f'series/lookup?term={query}')
+# TVDB/TMDB/IMDb IDs and links use Sonarr's prefixed lookups, which resolve a single series; a trailing "(year)" narrows and ranks full-text results
+def search(query: str, exact=False, backend: Backend = None):
+    parsed = query_parser.parse(query)
+    if parsed.is_id_lookup:
+        return lookup_by_id(parsed, backend=backend)
+
+    term = parsed.term.lower()
+    results = get(f'series/lookup?term={quote(term)}', backend=backend)
     matches = []
     if exact:
         for result in results:
-            if result['title'].lower() == query:
+            if result['title'].lower() == term:
                 matches.append(result)
     else: matches = results
-    return matches[:20] # Truncate results to 20 max to avoid errors sending options to discord
-
-def get_show_by_tvdbid(tvdb_id: int) -> dict:
+    if parsed.year: matches = query_parser.rank_by_year(matches, parsed.year)
+    return matches # Full results are kept; they're shown to the user a page at a time
+
+def lookup_by_id(parsed: ParsedQuery, backend: Backend = None) -> list[dict]:
+    """Looks up a single series by its TVDB, TMDB or IMDb ID. Returns an empty list if it isn't found, or if the ID is for a TMDB movie."""
+    if parsed.tmdb_kind == 'movie': return [] # TMDB movie IDs would look up an unrelated series
+    if parsed.tvdb_id: term = f'tvdb:{parsed.tvdb_id}'
+    elif parsed.tmdb_id: term = f'tmdb:{parsed.tmdb_id}'
+    else: term = f'imdb:{parsed.imdb_id}'
+    try:
+        return get(f'series/lookup?term={quote(term)}', backend=backend)
+    except HttpRequestException as e:
+        if e.code == 404: return []
+        raise
+
+def get_show_by_tvdbid(tvdb_id: int, backend: Backend = None) -> dict:
     """Retrieves a show by its TVDB ID.
     
     """
 
-    show = get(f'series?tvdbId={tvdb_id}')
+    show = get(f'series?tvdbId={tvdb_id}', backend=backend or get_backend())
     return show
 
-def get_show_by_id(id: int) -> dict:
+def get_show_by_id(id: int, backend: Backend = None) -> dict:
     """Retrieves a show by its internal DB ID.
 
     TODO: Throw an error for not found to force error handling.
     """
-    show = get(f'series/{id}')
+    show = get(f'series/{id}', backend=backend or get_backend())
     return show
 
+def get_shows(backend: Backend) -> list[dict]:
+    """Retrieves every show in a backend's library in a single call."""
+    return get('series', backend=backend)
+
+
+def get_episode_files(series_id: int, backend: Backend) -> list[dict]:
+    """Retrieves the episode files of one series. Much smaller than the full series object when only file counts are needed."""
+    return get(f'episodefile?seriesId={series_id}', backend=backend)
+
+def get_episodes(series_id: int, backend: Backend) -> list[dict]:
+    """Retrieves every episode of one series, including whether it's aired, monitored and has a file."""
+    return get(f'episode?seriesId={series_id}', backend=backend)
+
+
+def get_queue(backend: Backend) -> list[dict]:
+    """Retrieves every item in a backend's download queue. Usually a single call, unless the queue is longer than QUEUE_PAGE_SIZE."""
+    return arr_backends.get_queue(backend, get, QUEUE_PAGE_SIZE)
+
+
+def get_backend(name: str = None) -> Backend:
+    """Gets a Sonarr backend by name, or the default one if no name is given."""
+    return registry.get('sonarr', name)
+
+def route(show: dict) -> Backend:
+    """Picks the Sonarr backend a show should be added to."""
+    return registry.route('sonarr', show)
+
+
+def get_root_folder(backend: Backend) -> dict:
+    """Returns the root folder with the most free space on the given backend. Root folder stats are cached for a few minutes."""
+    return arr_backends.get_root_folder(backend, get, ROOT_FOLDER_PATH)
+
 
 def get_free_space(unit_exp: int = 4) -> float:
     """Returns the amount of free space on the server in TB.
 
+    With more than one backend, this is the most free space available in any one of their root folders. Backends that can't be
+    reached are skipped; the error is only raised if none of them can.
     If the unit_exp parameter is not passed, it defaults to 4, which corresponds to TB (1024^4)
     """
 
-    space_stats = get('rootfolder')
-    space_stats = space_stats[0]
-    free_space = space_stats['freeSpace']
-    return free_space / 1024**unit_exp
+    free_spaces, error = [], None
+    for backend in registry.all('sonarr'):
+        try: free_spaces.append(get_root_folder(backend)['freeSpace'])
+        except (requests.RequestException, HttpRequestException) as e: error = e
+    if not free_spaces: raise error
+    return max(free_spaces) / 1024**unit_exp
+
+
+
+def prepare(show: dict, download_now=True, backend: Backend = None) -> dict:
+    """Returns a copy of a standard dictionary returned from the Sonarr API, with the additional parameters needed to add it to the given backend (or the one it routes to)."""
+
+    backend = backend or route(show)
+    return show | {
+        'qualityProfileId': backend.quality_profile,
+        'languageProfileId': backend.language_profile,
+        'monitored': True,
+        'seasonFolder': True,
+        'addOptions': {
+            'monitor': 'all',
+            'searchForMissingEpisodes': download_now, # Search for movie when added? False for troubleshooting ONLY
+            'searchForCutoffUnmetEpisodes': False
+        },
+        'rootFolderPath': get_root_folder(backend)['path']
+    }
+
 
+def add(show: dict, download_now=True, backend: Backend = None):
+    """Takes a standard dictionary returned from the Sonarr API for the show to be added as an argument, tailors a copy with some additional parameters and POST's it to the API.
 
+    The show is added to the given backend, or routed to one if none is given.
+    """
 
-def add(show: dict, download_now=True):
-    """Takes a standard dictionary returned from the Sonarr API for the movie to be added as an argument, then tailors on some additional parameters and POST's it to the API."""
+    backend = backend or route(show)
+    return post('series', prepare(show, download_now, backend), backend=backend)
 
-    show_json = show
-    show_json['qualityProfileId'] = DEFAULT_QUALITY_PROFILE
-    show_json['languageProfileId'] = DEFAULT_LANGUAGE_PROFILE
-    show_json['monitored'] = True
-    show_json['seasonFolder'] = True
-    show_json['addOptions'] = {
-        'monitor': 'all',
-        'searchForMissingEpisodes': download_now, # Search for movie when added? False for troubleshooting ONLY
-        'searchForCutoffUnmetEpisodes': False
-    }
-    show_json['rootFolderPath'] = ROOT_FOLDER_PATH
 
-    return post('series', show_json)
+def add_many(shows: list[dict], download_now=True, backend: Backend = None) -> list[dict]:
+    """Adds several shows to one backend in a single call to Sonarr's bulk import endpoint, and returns the created shows.
+
+    The backend defaults to the one the first show routes to. Sonarr rejects the whole batch if any one show is invalid.
+    """
+
+    backend = backend or route(shows[0])
+    return post('series/import', [prepare(show, download_now, backend) for show in shows], backend=backend)
 
 
 
 # Makes a get call to the V3 Sonarr API using the extension of /api/v3/ without the preceding slash
+# Calls that aren't tied to one backend's library (lookups) are load balanced across backends when no backend is given
 # TODO: Generate errors based on error codes and FORCE error handling!
-def get(call, parameters={}):
+def get(call, parameters={}, backend: Backend = None):
+    backend = backend or registry.for_lookup('sonarr')
     headers = {
         'Content-Type':'application/json',
-        'X-Api-Key':SONARR_TOKEN
+        'X-Api-Key':backend.token
     }
     headers = headers | parameters
-    res = requests.get(f'http://{TORBOX_URL}:{SONARR_PORT}/api/v3/{call}', headers=headers)
+    start = time.monotonic()
+    try:
+        res = requests.get(backend.url(call), headers=headers, timeout=REQUEST_TIMEOUT)
+    except (requests.ConnectionError, requests.Timeout):
+        backend.record(time.monotonic() - start, ok=False)
+        raise
+    backend.record(time.monotonic() - start, ok=res.status_code < 500)
     # HTTP error
     if res.status_code >= 300:
         raise HttpRequestException(res.status_code)
@@ -103,7 +196,7 @@ def get(call, parameters={}):
 
 
 
-def post(call, json) -> None:
+def post(call, json, backend: Backend = None) -> None:
     """Makes a post request with the given call and json body.
 
     Takes a call and json object as an argument, and makes a post request to the Sonarr server passing that object as its json body.
@@ -111,11 +204,18 @@ def post(call, json) -> None:
 
     # Add necessary additional fields to json object
 
+    backend = backend or get_backend()
     headers = {
         'Content-Type':'application/json',
-        'X-Api-Key':SONARR_TOKEN
+        'X-Api-Key':backend.token
     }
-    res = requests.post(f"http://{TORBOX_URL}:{SONARR_PORT}/api/v3/{call}", headers=headers, json=json)
+    start = time.monotonic()
+    try:
+        res = requests.post(backend.url(call), headers=headers, json=json, timeout=REQUEST_TIMEOUT)
+    except (requests.ConnectionError, requests.Timeout):
+        backend.record(time.monotonic() - start, ok=False)
+        raise
+    backend.record(time.monotonic() - start, ok=res.status_code < 500)
 
     # HTTP code handling
     if res.status_code >= 300: